@@ -52,18 +52,11 @@ class RetentionHandler(object):
         sql_session.query(BCProcess).filter_by(container=container.container).delete(synchronize_session='fetch')
         sql_session.query(BCFile).filter_by(container=container.container).delete(synchronize_session='fetch')
         sql_session.commit()
-        measurements = [
-            "bc:container:" + container.container+ ":cpu:duration",
-            "bc:container:" + container.container+ ":mem:vm_size",
-            "bc:container:" + container.container+ ":fd:io:in",
-            "bc:container:" + container.container+ ":fd:io:out",
-            "bc:container:" + container.container+ ":fd:io:total"
-        ]
-        for measure in measurements:
-            try:
-                self.db_influx.delete_series(self.cfg['influxdb']['db'], measurement=measure)
-            except Exception  as e:
-                logging.exception("Failed to delete %s: %s" % (measure, str(e)))
+        # stats of all measurements are tagged by container
+        try:
+            self.db_influx.delete_series(self.cfg['influxdb']['db'], tags={'container': container.container})
+        except Exception  as e:
+            logging.exception("Failed to delete %s stats: %s" % (container.container, str(e)))
 
     def delete_old(self, days):
         logging.warn('Delete all container stats older than %d days' % (days))
@@ -4,15 +4,20 @@ Manage db init and upgrades
 import os
 import sys
 import logging
+import time
 import yaml
 
+import influxdb
+from influxdb.resultset import ResultSet
 from sqlalchemy import create_engine
+from sqlalchemy import inspect
 from sqlalchemy.orm import sessionmaker
 
 from bubblechamber.model import Base
 from bubblechamber.model import File as BCFile
 from bubblechamber.model import Process as BCProcess
 from bubblechamber.model import Container as BCContainer
+from bubblechamber import influx
 
 import click
 
@@ -40,14 +45,187 @@ def __load_config(debug):
     if os.environ.get('BC_MYSQL_URL', None):
         config['mysql']['url'] = os.environ['BC_MYSQL_URL']
 
+    if 'INFLUXDB_HOST' in os.environ:
+        config['influxdb']['host'] = os.environ['INFLUXDB_HOST']
+    if 'INFLUXDB_PORT' in os.environ:
+        config['influxdb']['port'] = int(os.environ['INFLUXDB_PORT'])
+    if 'INFLUXDB_DB' in os.environ:
+        config['influxdb']['db'] = os.environ['INFLUXDB_DB']
+    if 'INFLUXDB_USER' in os.environ:
+        config['influxdb']['user'] = os.environ['INFLUXDB_USER']
+    if 'INFLUXDB_PASSWORD' in os.environ:
+        config['influxdb']['password'] = os.environ['INFLUXDB_PASSWORD']
+
     return config
 
+def __influx_client(cfg):
+    host = cfg['influxdb']['host']
+    port = cfg['influxdb'].get('port', 8086)
+    username = cfg['influxdb']['user']
+    password = cfg['influxdb']['password']
+    database = cfg['influxdb']['db']
+    return influxdb.InfluxDBClient(host, port, username, password, database)
+
+def __create_rollups(cfg, backfill=False):
+    '''
+    Create or update retention policies and continuous queries of rollup tiers
+    '''
+    db_influx = __influx_client(cfg)
+    database = cfg['influxdb']['db']
+    retentions = dict(influx.ROLLUP_RETENTIONS)
+    retentions.update(cfg['influxdb'].get('retention', None) or {})
+
+    retention_policies = [rp['name'] for rp in db_influx.get_list_retention_policies(database)]
+    for (interval, retention_policy, group_interval) in influx.ROLLUPS:
+        if retention_policy in retention_policies:
+            logging.info('Update retention policy %s: %s' % (retention_policy, retentions[retention_policy]))
+            db_influx.alter_retention_policy(retention_policy, database=database, duration=retentions[retention_policy])
+        else:
+            logging.info('Create retention policy %s: %s' % (retention_policy, retentions[retention_policy]))
+            db_influx.create_retention_policy(retention_policy, retentions[retention_policy], 1, database=database)
+
+    res = db_influx.query('SHOW CONTINUOUS QUERIES')
+    continuous_queries = [cq['name'] for cq in res.get_points(measurement=database)]
+    recorder_rollups = []
+    if cfg['influxdb'].get('rollup', 'cq') == 'recorder':
+        recorder_rollups = [retention_policy for (retention_policy, size) in influx.RECORDER_ROLLUPS]
+    for (name, retention_policy, select, group_interval) in influx.rollup_queries(database):
+        if name in continuous_queries:
+            db_influx.query('DROP CONTINUOUS QUERY "%s" ON "%s"' % (name, database))
+        if retention_policy in recorder_rollups:
+            logging.info('Rollup %s is computed by recorder' % (name))
+        else:
+            # compute again previous interval too, to include late stats
+            resample = '%d%s' % (2 * int(group_interval[:-1]), group_interval[-1])
+            logging.info('Create continuous query %s' % (name))
+            db_influx.query('CREATE CONTINUOUS QUERY "%s" ON "%s" RESAMPLE FOR %s BEGIN %s END' % (name, database, resample, select))
+
+    if backfill:
+        __backfill_rollups(db_influx, database, retentions)
+
+def __backfill_rollups(db_influx, database, retentions):
+    '''
+    Compute rollups of already recorded stats
+
+    Each tier is computed from raw stats, previous tiers only keep the end of
+    the period of next ones.
+    '''
+    raw_seconds = None
+    for rp in db_influx.get_list_retention_policies(database):
+        if rp['default']:
+            raw_seconds = influx.duration_seconds(rp['duration'])
+    now = int(time.time())
+    end = now - now % 86400 + 86400
+    for (name, retention_policy, select, group_interval) in influx.rollup_queries(database, from_raw=True):
+        seconds = influx.duration_seconds(retentions[retention_policy]) or 3650 * 86400
+        if raw_seconds is not None:
+            seconds = min(seconds, raw_seconds)
+        start = now - seconds
+        start -= start % 86400
+        logging.info('Compute rollup %s from raw stats for last %d days' % (name, (end - start) // 86400))
+        # one query per day, aligned on days so that no bucket is computed in two parts
+        for day in range(start, end, 86400):
+            db_influx.query(select.replace(' GROUP BY ', ' WHERE time >= %ds AND time < %ds GROUP BY ' % (day, day + 86400)))
+
+def __create_indexes(engine):
+    '''
+    Create indexes added to already existing tables
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in indexes:
+                logging.info('Create index %s on %s' % (index.name, table.name))
+                index.create(engine)
+
 @run.command()
 @click.option('--debug', help="set log level to debug", is_flag=True)
 def init(debug):
     cfg =  __load_config(debug)
     engine = create_engine(cfg['mysql']['url'], pool_recycle=3600, echo=cfg['mysql'].get('debug', False))
     Base.metadata.create_all(engine)
+    __create_rollups(cfg)
+
+@run.command()
+@click.option('--backfill', help="compute rollups of already recorded stats", is_flag=True)
+@click.option('--debug', help="set log level to debug", is_flag=True)
+def upgrade(backfill, debug):
+    cfg =  __load_config(debug)
+    engine = create_engine(cfg['mysql']['url'], pool_recycle=3600, echo=cfg['mysql'].get('debug', False))
+    Base.metadata.create_all(engine)
+    __create_indexes(engine)
+    __create_rollups(cfg, backfill)
+
+
+@run.command()
+@click.option('--batch', help="number of points per write", type=int, default=10000)
+@click.option('--drop', help="drop old measurements once copied", is_flag=True)
+@click.option('--debug', help="set log level to debug", is_flag=True)
+def migrate(batch, drop, debug):
+    '''
+    Copy stats of per container measurements (bc:container:XX:...) to tagged cpu/mem/io measurements
+    '''
+    cfg =  __load_config(debug)
+    db_influx = __influx_client(cfg)
+    res = db_influx.query('SHOW MEASUREMENTS WITH MEASUREMENT =~ /^bc:container:/')
+    measurements = [m['name'] for m in res.get_points()]
+    logging.info('%d measurements to migrate' % (len(measurements)))
+    # legacy io out and total points have no system tag, it is taken from io in
+    # points of same proc and time, so that io fields of a proc share a serie:
+    # copy io in first, per container
+    measurements = [(influx.parse_legacy(measurement), measurement) for measurement in measurements]
+    measurements = sorted([(legacy, measurement) for (legacy, measurement) in measurements if legacy is not None],
+                          key=lambda elt: (elt[0][0], elt[0][3] != 'in', elt[1]))
+    # (proc, time) => system of io in points of current container
+    systems = {}
+    current = None
+    for (legacy, measurement) in measurements:
+        (container, new_measurement, old_field, new_field) = legacy
+        if container != current:
+            systems = {}
+            current = container
+        logging.info('Migrate %s' % (measurement))
+        query = 'SELECT "%s" FROM "%s" GROUP BY *' % (old_field, measurement)
+        results = db_influx.query(query, epoch='ns', chunked=True, chunk_size=batch)
+        if isinstance(results, ResultSet):
+            # older clients merge chunks in a single result
+            results = [results]
+        count = 0
+        points = []
+        for result in results:
+            for ((name, tags), serie) in result.items():
+                tags = dict(tags or {})
+                tags['container'] = container
+                if new_measurement == influx.IO and new_field == 'in':
+                    tags['system'] = str(tags.get('system', None) or 0)
+                for value in serie:
+                    if value[old_field] is None:
+                        continue
+                    point_tags = tags
+                    if new_measurement == influx.IO:
+                        key = (tags.get('proc', None), value['time'])
+                        if new_field == 'in':
+                            systems[key] = tags['system']
+                        else:
+                            point_tags = dict(tags)
+                            point_tags['system'] = systems.get(key, '0')
+                    points.append({
+                        'measurement': new_measurement,
+                        'tags': point_tags,
+                        'time': value['time'],
+                        'fields': {new_field: int(value[old_field])}
+                    })
+                    if len(points) >= batch:
+                        db_influx.write_points(points, time_precision='n')
+                        count += len(points)
+                        points = []
+        if points:
+            db_influx.write_points(points, time_precision='n')
+            count += len(points)
+        logging.info('Copied %d points of %s' % (count, measurement))
+        if drop:
+            db_influx.query('DROP MEASUREMENT "%s"' % (measurement))
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import os
+import io
 import json
 import logging
 import sys
@@ -7,31 +8,189 @@ import re
 import copy
 import datetime
 import time
+import signal
 import yaml
+import zlib
+import multiprocessing
+import socket
 
 from bson import json_util
 
 import pika
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 from progressbar import Percentage, ProgressBar, Bar
 import click
 
 import influxdb
+from prometheus_client import Gauge, start_http_server
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 
 from bubblechamber.model import File as BCFile
 from bubblechamber.model import Process as BCProcess
 from bubblechamber.model import Container as BCContainer
+from bubblechamber.cache import LRUCache
+from bubblechamber import cgroup
+from bubblechamber import influx
+from bubblechamber import live
+from bubblechamber.rollups import Rollups
+
+# messages which cannot be decoded, kept for inspection instead of being requeued
+FAILED_QUEUE = 'bc_record_failed'
+MAX_EVENT_SIZE = 32 * 1024 * 1024
+
+
+class UnsupportedEncoding(Exception):
+    '''
+    Message is valid but cannot be decoded by this process (missing module)
+    '''
+    pass
+
+
+class EventTooLarge(Exception):
+    '''
+    Decompressed message is larger than max event size
+    '''
+    pass
+
+
+def decode_event(properties, body, max_size=MAX_EVENT_SIZE):
+    '''
+    Decode a chisel event message
+
+    Web tier forwards chisel payload as is, possibly compressed (content_encoding),
+    older messages wrap it in an event key
+    '''
+    if properties is not None and properties.content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # one more byte than allowed tells that payload is too large
+        body = decompressor.decompress(body, max_size + 1)
+    elif properties is not None and properties.content_encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedEncoding('zstandard module is needed to decode zstd messages')
+        chunks = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+            while size <= max_size:
+                chunk = reader.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        body = b''.join(chunks)
+    if len(body) > max_size:
+        raise EventTooLarge('event is larger than %d bytes' % (max_size))
+    content = json.loads(body)
+    if content is not None and 'event' in content:
+        content = content['event']
+    return content
+
+
+def reject_message(channel, properties, body, error):
+    '''
+    Publish a message which cannot be decoded to failed queue, with the error
+    in its headers
+
+    Return False if message was not published
+    '''
+    headers = dict(properties.headers or {})
+    headers['error'] = str(error)[:256]
+    return channel.basic_publish(
+        exchange='',
+        routing_key=FAILED_QUEUE,
+        body=body,
+        properties=pika.BasicProperties(
+            delivery_mode=2,
+            content_type=properties.content_type,
+            content_encoding=properties.content_encoding,
+            headers=headers
+        ))
+
+
+def declare_failed_queue(channel, config):
+    channel.queue_declare(
+        queue=FAILED_QUEUE,
+        durable=True,
+        arguments={'x-max-length': config['rabbitmq'].get('failed_queue_size', 10000)})
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+INFLUX_BUFFER_DEPTH = Gauge('bc_record_influx_buffer_points', 'Number of points waiting to be written to influxdb')
 
 @click.group()
 def run():
     pass
 
 
+class InfluxBuffer(object):
+    '''
+    Buffer influxdb points and write them by batches
+    '''
+
+    def __init__(self, db_influx, max_points=5000, max_age=1, retries=3):
+        self.db_influx = db_influx
+        self.max_points = max_points
+        self.max_age = max_age
+        self.retries = retries
+        # points per retention policy, None being default retention policy
+        self.points = {}
+
+    def add(self, points, retention_policy=None):
+        if retention_policy not in self.points:
+            self.points[retention_policy] = []
+        self.points[retention_policy].extend(points)
+        INFLUX_BUFFER_DEPTH.set(self.depth())
+
+    def depth(self):
+        return sum([len(points) for points in self.points.values()])
+
+    def is_full(self):
+        return self.depth() >= self.max_points
+
+    def flush(self):
+        '''
+        Write buffered points, retrying with exponential backoff on failure
+
+        Return True if all points were written, else points are kept for next flush
+        '''
+        if self.db_influx is None:
+            self.points = {}
+            INFLUX_BUFFER_DEPTH.set(0)
+            return True
+        for retention_policy in list(self.points.keys()):
+            if not self.__write(self.points[retention_policy], retention_policy):
+                return False
+            del self.points[retention_policy]
+            INFLUX_BUFFER_DEPTH.set(self.depth())
+        return True
+
+    def __write(self, points, retention_policy):
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            try:
+                self.db_influx.write_points(points, retention_policy=retention_policy, batch_size=self.max_points)
+                logging.debug('Stat:Flush:%d points' % (len(points)))
+                return True
+            except Exception as e:
+                logging.exception('Stat:Error:' + str(e))
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+        return False
+
+
 class RetentionHandler(object):
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, queue='bc_record'):
         self.cfg = cfg
         self.engine = create_engine(self.cfg['mysql']['url'], pool_recycle=3600, echo=self.cfg['mysql'].get('debug', False))
         self.SqlSession = sessionmaker(bind=self.engine)
@@ -43,16 +202,97 @@ class RetentionHandler(object):
             password = self.cfg['influxdb']['password']
             database = self.cfg['influxdb']['db']
             self.db_influx = influxdb.InfluxDBClient(host, port, username, password, database)
+        # max number of rows per INSERT statement
+        self.batch_size = self.cfg['mysql'].get('batch_size', 500)
+        # pending sql changes, coalesced by primary key until next flush
+        self.sql_files = {}
+        self.sql_procs = {}
+        self.sql_containers = {}
+        # stats of current message, by container, process and timestamp
+        self.cpu_points = {}
+        self.io_points = {}
+        # last written process metadata and container update, to skip unchanged rows
+        self.update_period = datetime.timedelta(seconds=self.cfg['mysql'].get('update_period', 10))
+        self.proc_cache = LRUCache(
+            maxsize=self.cfg['mysql'].get('cache_size', 100000),
+            ttl=self.cfg['mysql'].get('cache_ttl', 3600)
+        )
+        self.container_cache = LRUCache(
+            maxsize=self.cfg['mysql'].get('cache_size', 100000),
+            ttl=self.cfg['mysql'].get('cache_ttl', 3600)
+        )
+        self.influx_buffer = InfluxBuffer(
+            self.db_influx,
+            max_points=self.cfg['influxdb'].get('batch_size', 5000),
+            max_age=self.cfg['influxdb'].get('batch_age', 1),
+            retries=self.cfg['influxdb'].get('retries', 3)
+        )
+        # per minute and hour stats, when not computed by continuous queries
+        self.rollups = None
+        if self.cfg['influxdb'].get('rollup', 'cq') == 'recorder':
+            # checkpoint_dir may be shared by several hosts
+            self.rollups = Rollups(
+                checkpoint=os.path.join(
+                    self.cfg['influxdb'].get('checkpoint_dir', '.'),
+                    'bc_rollups_%s_%s.json' % (socket.gethostname(), queue)
+                ),
+                grace=self.cfg['influxdb'].get('rollup_grace', 30),
+                checkpoint_interval=self.cfg['influxdb'].get('rollup_checkpoint_interval', 60),
+                idle_timeout=self.cfg['influxdb'].get('rollup_idle_timeout', 60)
+            )
+        # rabbitmq deliveries covered by pending changes, acked on flush
+        self.channel = None
+        self.connection = None
+        self.deliveries = []
+        self.prefetch = self.cfg['rabbitmq'].get('prefetch', 100)
+        self.max_event_size = self.cfg['rabbitmq'].get('max_event_size', MAX_EVENT_SIZE)
+        # publish stats of each message to live exchange for web viewers
+        self.live = self.cfg['rabbitmq'].get('live', True)
 
     def __add_influx(self, data):
-        try:
-            self.db_influx.write_points(data)
-        except Exception as e:
-            # Do not fail on stat writing
-            logging.exception('Stat:Error:' + str(e))
+        self.influx_buffer.add(data)
+
+    def flush(self, checkpoint=False):
+        '''
+        Write pending sql and influxdb changes, then ack related deliveries
+
+        Deliveries stay unacked if mysql or influxdb write fails, they will be
+        acked at next successful flush. Rollups are saved before deliveries
+        are acked, checkpoint is written every rollup_checkpoint_interval
+        seconds (or now if checkpoint is set) and journal in between.
+        '''
+        sql_ok = self.__flush_sql()
+        if self.rollups is not None:
+            rollup_points = self.rollups.pop_finished()
+            for retention_policy in rollup_points:
+                self.influx_buffer.add(rollup_points[retention_policy], retention_policy)
+        if not self.influx_buffer.flush() or not sql_ok:
+            return False
+        if self.rollups is not None:
+            # rollups of deliveries must be saved before they are acked
+            try:
+                self.rollups.save(force=checkpoint)
+            except Exception as e:
+                logging.exception('Failed to save rollups checkpoint: ' + str(e))
+                return False
+        if self.deliveries:
+            # deliveries are acked in order, a single ack covers all previous ones
+            try:
+                self.channel.basic_ack(delivery_tag=self.deliveries[-1], multiple=True)
+            except Exception as e:
+                logging.exception('Failed to ack messages: ' + str(e))
+        self.deliveries = []
+        return True
+
+    def on_timer(self):
+        '''
+        Flush pending changes every batch_age seconds
+        '''
+        if self.deliveries or self.influx_buffer.depth():
+            self.flush()
+        self.connection.add_timeout(self.influx_buffer.max_age, self.on_timer)
 
     def __add_cpu_mem(self, event):
-        session = self.SqlSession()
         '''
             container = Column(String(64), primary_key=True)
             process_id = Column(Integer, primary_key=True)
@@ -60,57 +300,38 @@ class RetentionHandler(object):
             arguments = Column(String(256))
             parent_id = Column(Integer)
         '''
-        bc_proc = BCProcess(
-            container=event['container'],
-            process_id=event['proc'],
-        )
-
-        bc_proc = session.merge(bc_proc)
-        bc_proc.name = event['proc_name']
-        bc_proc.exe = event['exe']
-        bc_proc.arguments = event['args']
-        bc_proc.parent_id = event['parent_id']
-        bc_proc.is_root = event['is_root']
-        bc_proc.last_updated = datetime.datetime.now()
-
-        bc_container = BCContainer(container=event['container'])
-        bc_container = session.merge(bc_container)
-        bc_container.last_updated = datetime.datetime.now()
-
-        session.commit()
-        session.close()
-        # add influx cpu and mem
-        points = [
-            {
-                "measurement": "bc:container:" + event['container']+ ":mem:vm_size",
-                "tags": {
-                    "proc": event['proc']
-                },
-                "time": event['ts'],
-                "fields": {
-                    "bytes": event['vm_size'],
-                }
-            },
-            {
-                "measurement": "bc:container:" + event['container']+ ":cpu:duration",
-                "tags": {
-                    "proc": event['proc']
-                },
-                "time": event['ts'],
-                "fields": {
-                    "duration": event['duration'],
-                }
+        now = datetime.datetime.now()
+        key = (event['container'], event['proc'])
+        meta = (event['proc_name'], event['exe'], event['args'], event['parent_id'], event['is_root'])
+        cached = self.proc_cache.get(key)
+        # write process only if metadata changed or last update is too old
+        if cached is None or cached[0] != meta or now - cached[1] >= self.update_period:
+            self.sql_procs[key] = {
+                'container': event['container'],
+                'process_id': event['proc'],
+                'name': event['proc_name'],
+                'exe': event['exe'],
+                'arguments': event['args'],
+                'parent_id': event['parent_id'],
+                'is_root': event['is_root'],
+                'last_updated': now
             }
-        ]
-        self.__add_influx(points)
+            self.proc_cache.set(key, (meta, now))
+        last_updated = self.container_cache.get(event['container'])
+        if last_updated is None or now - last_updated >= self.update_period:
+            self.sql_containers[event['container']] = now
+            self.container_cache.set(event['container'], now)
+
+        # sum cpu of all cpus used by process, points are written by __add_points
+        key = (event['container'], event['proc'], event['ts'])
+        stat = self.cpu_points.get(key, None)
+        if stat is None:
+            stat = [0, 0]
+            self.cpu_points[key] = stat
+        stat[0] += int(event['duration'])
+        stat[1] = max(stat[1], event['vm_size'])
 
     def __add_fd(self, event):
-        session = self.SqlSession()
-        bc_file = BCFile(
-            container=event['container'],
-            process_id=event['proc'],
-            name=event['name']
-        )
         '''
         event = {
             'proc': int(data[0]),
@@ -121,54 +342,165 @@ class RetentionHandler(object):
             'in_out': 0
             'start':  long(content['ts'])/1000000
         '''
-
-        bc_file = session.merge(bc_file)
-        bc_file.io_in = BCFile.io_in + event['in']
-        bc_file.io_out = BCFile.io_out + event['out']
-        bc_file.io_total = BCFile.io_total + event['in_out']
-        is_system = 0
-        if bc_file.name.startswith('/etc') or bc_file.name.startswith('/usr') or bc_file.name.startswith('/lib'):
-            is_system = 1
-
-        session.commit()
-        session.close()
-
-        # Then add to influx io global streams
-        points = [
-            {
-                "measurement": "bc:container:" + event['container']+ ":fd:io:in",
+        key = (event['container'], event['proc'], event['name'])
+        bc_file = self.sql_files.get(key, None)
+        if bc_file is None:
+            bc_file = {
+                'container': event['container'],
+                'process_id': event['proc'],
+                'name': event['name'],
+                'io_in': 0,
+                'io_out': 0,
+                'io_total': 0
+            }
+            self.sql_files[key] = bc_file
+        bc_file['io_in'] += event['in']
+        bc_file['io_out'] += event['out']
+        bc_file['io_total'] += event['in_out']
+        bc_file['last_updated'] = datetime.datetime.now()
+        # sum io of all files of process, points are written by __add_points
+        key = (event['container'], event['proc'], influx.is_system(event['name']), event['ts'])
+        stat = self.io_points.get(key, None)
+        if stat is None:
+            stat = [0, 0, 0]
+            self.io_points[key] = stat
+        stat[0] += int(event['in'])
+        stat[1] += int(event['out'])
+        stat[2] += int(event['in_out'])
+
+    def __add_points(self):
+        '''
+        Add stats of current message to influxdb buffer, with one point per
+        container, process (and system flag for io) and timestamp
+        '''
+        points = []
+        for (container, proc, ts) in self.cpu_points:
+            (duration, vm_size) = self.cpu_points[(container, proc, ts)]
+            points.append({
+                "measurement": influx.CPU,
                 "tags": {
-                    "proc": event['proc'],
-                    "system": is_system
+                    "container": container,
+                    "proc": proc
                 },
-                "time": event['ts'],
+                "time": ts,
                 "fields": {
-                    "bytes": event['in'],
+                    "duration": duration
                 }
-            },
-            {
-                "measurement": "bc:container:" + event['container']+ ":fd:io:out",
+            })
+            points.append({
+                "measurement": influx.MEM,
                 "tags": {
-                    "proc": event['proc']
+                    "container": container,
+                    "proc": proc
                 },
-                "time": event['ts'],
+                "time": ts,
                 "fields": {
-                    "bytes": event['out'],
+                    "vm_size": vm_size
                 }
-            },
-            {
-                "measurement": "bc:container:" + event['container']+ ":fd:io:total",
+            })
+        for (container, proc, system, ts) in self.io_points:
+            (io_in, io_out, io_total) = self.io_points[(container, proc, system, ts)]
+            points.append({
+                "measurement": influx.IO,
                 "tags": {
-                    "proc": event['proc']
+                    "container": container,
+                    "proc": proc,
+                    "system": system
                 },
-                "time": event['ts'],
+                "time": ts,
                 "fields": {
-                    "bytes": event['in'] + event['out'],
+                    "in": io_in,
+                    "out": io_out,
+                    "total": io_total
                 }
-            }
-        ]
+            })
+        if self.rollups is not None:
+            for point in points:
+                self.rollups.add(
+                    point['measurement'],
+                    point['tags']['container'],
+                    point['tags']['proc'],
+                    point['tags'].get('system', None),
+                    point['time'],
+                    point['fields']
+                )
+        self.cpu_points = {}
+        self.io_points = {}
+        if self.live and points:
+            self.__publish_live(points)
         self.__add_influx(points)
 
+    def __publish_live(self, points):
+        '''
+        Publish points to live exchange, one message per container
+        '''
+        containers = {}
+        for point in points:
+            container = point['tags']['container']
+            if container not in containers:
+                containers[container] = []
+            containers[container].append(point)
+        try:
+            for container in containers:
+                self.channel.basic_publish(
+                    exchange=live.EXCHANGE,
+                    routing_key=live.routing_key(container),
+                    body=live.encode(container, containers[container]))
+        except Exception as e:
+            logging.exception('Failed to publish live stats: ' + str(e))
+
+    def __upsert(self, conn, table, rows, update):
+        '''
+        Insert rows by chunks of batch_size, update columns returned by
+        update(stmt) on duplicate primary key
+        '''
+        for i in range(0, len(rows), self.batch_size):
+            stmt = mysql_insert(table).values(rows[i:i + self.batch_size])
+            stmt = stmt.on_duplicate_key_update(**update(stmt))
+            conn.execute(stmt)
+
+    def __flush_sql(self):
+        '''
+        Write pending File, Process and Container changes in a single transaction
+
+        Return False if transaction failed, changes are then kept for next flush
+        '''
+        if not self.sql_files and not self.sql_procs and not self.sql_containers:
+            return True
+        # Sort by primary key so that concurrent recorders lock rows in the same order
+        files = [self.sql_files[key] for key in sorted(self.sql_files.keys())]
+        procs = [self.sql_procs[key] for key in sorted(self.sql_procs.keys())]
+        containers = [{'container': key, 'last_updated': self.sql_containers[key]} for key in sorted(self.sql_containers.keys())]
+        try:
+            with self.engine.begin() as conn:
+                self.__upsert(conn, BCProcess.__table__, procs, lambda stmt: {
+                    'name': stmt.inserted.name,
+                    'exe': stmt.inserted.exe,
+                    'arguments': stmt.inserted.arguments,
+                    'parent_id': stmt.inserted.parent_id,
+                    'is_root': stmt.inserted.is_root,
+                    'last_updated': stmt.inserted.last_updated
+                })
+                self.__upsert(conn, BCContainer.__table__, containers, lambda stmt: {
+                    'last_updated': stmt.inserted.last_updated
+                })
+                self.__upsert(conn, BCFile.__table__, files, lambda stmt: {
+                    'io_in': BCFile.__table__.c.io_in + stmt.inserted.io_in,
+                    'io_out': BCFile.__table__.c.io_out + stmt.inserted.io_out,
+                    'io_total': BCFile.__table__.c.io_total + stmt.inserted.io_total,
+                    'last_updated': stmt.inserted.last_updated
+                })
+            logging.debug('Recorded %d procs, %d containers, %d files' % (len(procs), len(containers), len(files)))
+        except Exception as e:
+            logging.exception('Failed to record batch: ' + str(e))
+            # transaction is rolled back, pending changes are written again at
+            # next flush, with increments of new events added to pending files
+            return False
+        self.sql_files = {}
+        self.sql_procs = {}
+        self.sql_containers = {}
+        return True
+
     def __get_retention_interval(self, retention):
         '''
         Return timestamp (ms) interval before which events should be deleted
@@ -193,42 +525,27 @@ class RetentionHandler(object):
     def __get_ts(self, event_date):
         return int(time.mktime(event_date.timetuple())*1000)
 
-    def is_cgroup(self, data_cgroup):
-        if data_cgroup.startswith('/'):
-            return True
-        else:
-            return False
-
-    def is_docker(self, data_cpuset):
-        if '/docker' in data_cpuset:
-            return True
-        return False
-
-    def is_slurm(self, data_cpuset):
-        if '/slurm' in data_cpuset:
-            cpuset = data_cpuset.split('/')
-            for fsg in cpuset:
-                if fsg.startswith('job_'):
-                    return (True, fsg)
-        return (False, None)
-
     def callback_record(self, ch, method, properties, body):
         try:
-            rt = json.loads(body)
-            content = rt['event']
+            content = decode_event(properties, body, self.max_event_size)
+        except Exception as e:
+            # message is acked with next flush
+            logging.exception('Failed to decode message, move it to %s: %s' % (FAILED_QUEUE, str(e)))
+            content = None
+            try:
+                reject_message(ch, properties, body, e)
+            except Exception as err:
+                logging.exception('Failed to publish message to %s: %s' % (FAILED_QUEUE, str(err)))
+        try:
             logging.debug('Message: %s' % (content))
             if content is None or 'evt_type' not in content:
-                ch.basic_ack(delivery_tag=method.delivery_tag)
                 return
             if content['evt_type'] == 'fd':
                 for data in content['data']:
-                    is_cgroup = self.is_cgroup(data[2])
-                    if is_cgroup:
-                        if self.is_docker(data[2]):
-                            continue
-                        (is_slurm, cgroup) = self.is_slurm(data[2])
-                        if is_slurm:
-                            data[2] = cgroup
+                    (container, is_slurm) = cgroup.classify(data[2])
+                    if container is None:
+                        continue
+                    data[2] = container
                     # event['in'], event['out'], event['proc'], event['name'], event['container']
                     event = {
                         'proc': int(data[0]),
@@ -249,16 +566,13 @@ class RetentionHandler(object):
 
             elif content['evt_type'] == 'cpu':
                 for data in content['data']:
-                    is_cgroup = self.is_cgroup(data[5])
-                    if is_cgroup:
-                        if self.is_docker(data[5]):
-                            continue
-                        (is_slurm, cgroup) = self.is_slurm(data[5])
-                        if is_slurm:
-                            data[5] = cgroup
+                    (container, is_slurm) = cgroup.classify(data[5])
+                    if container is None:
+                        continue
+                    data[5] = container
 
                     is_root = 0
-                    if is_cgroup and is_slurm and 'slurm_script' in data[7]:
+                    if is_slurm and 'slurm_script' in data[7]:
                         is_root = 1
 
                     if int(data[3]) == 1:
@@ -285,12 +599,283 @@ class RetentionHandler(object):
         except Exception as e:
             logging.exception("Failed to handle retention query: " + str(e))
         finally:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.__add_points()
+            self.deliveries.append(method.delivery_tag)
+            # broker stops sending messages once prefetch window is full
+            if self.influx_buffer.is_full() or len(self.deliveries) >= self.prefetch:
+                self.flush()
+
+
+class ShardRouter(object):
+    '''
+    Split events by container and forward them to worker queues, so that
+    a container is always recorded by the same worker
+
+    Router channel is transactional: publishes and acks of routed messages
+    are committed by batches, and rolled back together if router dies.
+    '''
+
+    def __init__(self, workers, routed, max_event_size=MAX_EVENT_SIZE, batch_size=50, batch_age=1):
+        self.workers = workers
+        # shared counters of rows sent to each worker
+        self.routed = routed
+        self.max_event_size = max_event_size
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.channel = None
+        self.connection = None
+        # messages routed since last commit
+        self.pending = 0
+
+    def get_shard(self, container):
+        return (zlib.crc32(container.encode('utf-8')) & 0xffffffff) % self.workers
+
+    def split(self, content):
+        '''
+        Return rows of event per shard
+        '''
+        if content is None or 'evt_type' not in content:
+            return {}
+        if content['evt_type'] == 'fd':
+            container_index = 2
+        elif content['evt_type'] == 'cpu':
+            container_index = 5
+        else:
+            return {}
+        shards = {}
+        for data in content['data']:
+            (container, is_slurm) = cgroup.classify(data[container_index])
+            if container is None:
+                continue
+            data[container_index] = container
+            shard = self.get_shard(container)
+            if shard not in shards:
+                shards[shard] = []
+            shards[shard].append(data)
+        return shards
+
+    def commit(self):
+        '''
+        Commit publishes and acks of pending messages
+
+        Raises if commit fails, router must then stop: closing its channel
+        rolls back the transaction and messages are delivered again.
+        '''
+        if not self.pending:
+            return
+        self.channel.tx_commit()
+        self.pending = 0
+
+    def on_timer(self):
+        '''
+        Commit pending messages every batch_age seconds
+        '''
+        self.commit()
+        self.connection.add_timeout(self.batch_age, self.on_timer)
+
+    def callback_route(self, ch, method, properties, body):
+        try:
+            content = decode_event(properties, body, self.max_event_size)
+            shards = self.split(content)
+        except Exception as e:
+            # invalid message would be received again and again
+            logging.exception('Failed to decode message, move it to %s: %s' % (FAILED_QUEUE, str(e)))
+            reject_message(ch, properties, body, e)
+            shards = {}
+        if len(shards) == 1:
+            # forward message as is, recorder classifies containers again
+            shard = list(shards.keys())[0]
+            self.__publish(ch, shard, body, properties.content_encoding, properties.headers)
+            self.routed[shard] += len(shards[shard])
+        elif shards:
+            # keep compressed events compressed
+            encoding = None
+            if properties.content_encoding in ('gzip', 'zstd'):
+                encoding = 'gzip'
+            for shard in shards:
+                sub_content = copy.copy(content)
+                sub_content['data'] = shards[shard]
+                sub_body = json.dumps(sub_content)
+                if encoding:
+                    sub_body = gzip_compress(sub_body.encode('utf-8'))
+                self.__publish(ch, shard, sub_body, encoding, properties.headers)
+                self.routed[shard] += len(shards[shard])
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def __publish(self, ch, shard, body, encoding, headers):
+        ch.basic_publish(
+            exchange='',
+            routing_key='bc_record_%d' % (shard),
+            body=body,
+            properties=pika.BasicProperties(
+                # make message persistent
+                delivery_mode=2,
+                content_type='application/json',
+                content_encoding=encoding,
+                headers=headers
+            ))
+
+
+def __on_sigterm(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def __rabbitmq_connect(config):
+    if config['rabbitmq']['user']:
+        credentials = pika.PlainCredentials(config['rabbitmq']['user'], config['rabbitmq']['password'])
+        return pika.BlockingConnection(pika.ConnectionParameters(config['rabbitmq']['host'], credentials=credentials, heartbeat_interval=0))
+    return pika.BlockingConnection(pika.ConnectionParameters(config['rabbitmq']['host'], heartbeat_interval=0))
+
+
+def __basic_consume(channel, callback, queue, exclusive=False):
+    try:
+        channel.basic_consume(callback, queue=queue, exclusive=exclusive)
+    except pika.exceptions.ChannelClosed as e:
+        if exclusive:
+            logging.error('Queue %s is already consumed, influxdb rollup recorder needs a single bc_record listen: %s' % (queue, str(e)))
+        raise e
+
+
+def __consume(config, queue, metrics_port):
+    '''
+    Record events received on queue
+    '''
+    rtHandler = RetentionHandler(config, queue)
+
+    connection = __rabbitmq_connect(config)
+    channel = connection.channel()
+    rtHandler.channel = channel
+    rtHandler.connection = connection
+    channel.queue_declare(queue=queue, durable=True)
+    declare_failed_queue(channel, config)
+    if rtHandler.live:
+        channel.exchange_declare(exchange=live.EXCHANGE, exchange_type='topic')
+    # messages are acked once their points are flushed, so keep enough
+    # unacked messages in flight to fill write batches
+    channel.basic_qos(prefetch_count=rtHandler.prefetch)
+    # with recorder rollups, events of a container must always be recorded
+    # by the same process: a single consumer is allowed on the queue
+    __basic_consume(channel, rtHandler.callback_record, queue, exclusive=rtHandler.rollups is not None)
+    if metrics_port:
+        start_http_server(metrics_port)
+    connection.add_timeout(rtHandler.influx_buffer.max_age, rtHandler.on_timer)
+    signal.signal(signal.SIGTERM, __on_sigterm)
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        logging.warn('Stopping, flush pending records')
+        channel.stop_consuming()
+    finally:
+        rtHandler.flush(checkpoint=True)
+        connection.close()
+
+
+def __route(config, workers, routed):
+    '''
+    Dispatch events of bc_record queue to worker queues
+    '''
+    router = ShardRouter(
+        workers,
+        routed,
+        max_event_size=config['rabbitmq'].get('max_event_size', MAX_EVENT_SIZE),
+        # uncommitted acks count in prefetch window
+        batch_size=min(config['rabbitmq'].get('router_batch_size', 50), config['rabbitmq'].get('prefetch', 100)),
+        batch_age=config['rabbitmq'].get('router_batch_age', 1)
+    )
+    connection = __rabbitmq_connect(config)
+    channel = connection.channel()
+    router.channel = channel
+    router.connection = connection
+    channel.queue_declare(queue='bc_record', durable=True)
+    declare_failed_queue(channel, config)
+    for i in range(workers):
+        channel.queue_declare(queue='bc_record_%d' % (i), durable=True)
+    # routed parts and ack of source message are committed together
+    channel.tx_select()
+    channel.basic_qos(prefetch_count=config['rabbitmq'].get('prefetch', 100))
+    __basic_consume(channel, router.callback_route, 'bc_record', exclusive=config['influxdb'].get('rollup', 'cq') == 'recorder')
+    connection.add_timeout(router.batch_age, router.on_timer)
+    signal.signal(signal.SIGTERM, __on_sigterm)
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        channel.stop_consuming()
+        router.commit()
+    finally:
+        connection.close()
+
+
+def __report_load(config, workers, routed, restarts):
+    '''
+    Log rows routed to, pending messages and restarts of each worker
+    '''
+    depths = {}
+    try:
+        connection = __rabbitmq_connect(config)
+        channel = connection.channel()
+        for i in range(workers):
+            res = channel.queue_declare(queue='bc_record_%d' % (i), durable=True, passive=True)
+            depths[i] = res.method.message_count
+        connection.close()
+    except Exception as e:
+        logging.warn('Failed to get queues depth: ' + str(e))
+    for i in range(workers):
+        logging.info('Worker:%d:rows=%d:pending=%s:restarts=%d' % (i, routed[i], str(depths.get(i, '?')), restarts['worker_%d' % (i)]))
+
+
+def __supervise(config, workers, metrics_port):
+    '''
+    Start router and workers processes, restart them if they die
+    '''
+    routed = multiprocessing.Array('l', workers)
+    targets = {'router': (__route, (config, workers, routed))}
+    for i in range(workers):
+        worker_metrics_port = None
+        if metrics_port:
+            worker_metrics_port = metrics_port + i
+        targets['worker_%d' % (i)] = (__consume, (config, 'bc_record_%d' % (i), worker_metrics_port))
+
+    processes = {}
+    restarts = {}
+    for name in targets:
+        restarts[name] = 0
+        processes[name] = multiprocessing.Process(target=targets[name][0], args=targets[name][1], name=name)
+        processes[name].start()
+
+    check_interval = 5
+    report_interval = config['rabbitmq'].get('report_interval', 60)
+    last_report = time.time()
+    signal.signal(signal.SIGTERM, __on_sigterm)
+    try:
+        while True:
+            time.sleep(check_interval)
+            for name in targets:
+                if not processes[name].is_alive():
+                    logging.error('Process %s died (exit code %s), restart it' % (name, str(processes[name].exitcode)))
+                    restarts[name] += 1
+                    processes[name] = multiprocessing.Process(target=targets[name][0], args=targets[name][1], name=name)
+                    processes[name].start()
+            if time.time() - last_report >= report_interval:
+                __report_load(config, workers, routed, restarts)
+                last_report = time.time()
+    except KeyboardInterrupt:
+        logging.warn('Stopping workers')
+        # workers flush pending records on SIGTERM
+        for name in processes:
+            processes[name].terminate()
+        for name in processes:
+            processes[name].join()
 
 
 @run.command()
 @click.option('--debug', help="set log level to debug", is_flag=True)
-def listen(debug):
+@click.option('--metrics-port', help="expose prometheus metrics on this port", type=int)
+@click.option('--prefetch', help="max number of unacked messages (default 100)", type=int)
+@click.option('--workers', help="number of recorder processes, events are sharded by container", type=int, default=1)
+def listen(debug, metrics_port, prefetch, workers):
     '''
     For rabbitmq credentials MUST use env variables RABBITMQ_USER and RABBITMQ_PASSWORD
     '''
@@ -306,6 +891,8 @@ def listen(debug):
     if debug:
         config['debug'] = True
         logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
 
     if os.environ.get('BC_MYSQL_URL', None):
         config['mysql']['url'] = os.environ['BC_MYSQL_URL']
@@ -317,6 +904,9 @@ def listen(debug):
             config['rabbitmq']['user'] = os.environ['RABBITMQ_USER']
             config['rabbitmq']['password'] = os.environ['RABBITMQ_PASSWORD']
 
+    if prefetch:
+        config['rabbitmq']['prefetch'] = prefetch
+
     if 'INFLUXDB_HOST' in os.environ:
         config['influxdb']['host'] = os.environ['INFLUXBD_HOST']
     if 'INFLUXDB_PORT' in os.environ:
@@ -328,22 +918,13 @@ def listen(debug):
     if 'INFLUXDB_PASSWORD' in os.environ:
         config['influxdb']['password'] = os.environ['INFLUXBD_PASSWORD']
 
-    rtHandler = RetentionHandler(config)
+    if zstandard is None:
+        logging.warn('zstandard module is not installed, zstd compressed messages will be moved to %s queue' % (FAILED_QUEUE))
 
-    connection = None
-    if config['rabbitmq']['user']:
-        credentials = pika.PlainCredentials(config['rabbitmq']['user'], config['rabbitmq']['password'])
-        connection = pika.BlockingConnection(pika.ConnectionParameters(config['rabbitmq']['host'], credentials=credentials, heartbeat_interval=0))
+    if workers > 1:
+        __supervise(config, workers, metrics_port)
     else:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(config['rabbitmq']['host'], heartbeat_interval=0))
-    channel = connection.channel()
-    rtHandler.channel = channel
-    channel.queue_declare(queue='bc_record', durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(
-            rtHandler.callback_record,
-            queue='bc_record')
-    channel.start_consuming()
+        __consume(config, 'bc_record', metrics_port)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,568 @@
+'''
+Asynchronous read api (python 3), serving the same /container/... urls and json
+as bc_web_record, with async http queries to influxdb and a pool of async mysql
+connections, so that a single process can handle many slow stats queries at once.
+
+Events (/event) and live stats are still served by bc_web_record.
+'''
+import os
+import json
+import logging
+import math
+import asyncio
+import calendar
+import datetime
+import email.utils
+
+import yaml
+import jwt
+import click
+import aiohttp
+import aiomysql
+from aiohttp import web
+from sqlalchemy.engine.url import make_url
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from prometheus_client import Counter
+from prometheus_client.exposition import generate_latest, CONTENT_TYPE_LATEST
+
+from bubblechamber.cache import LRUCache, QueryCache, aligned_ttl
+from bubblechamber import influx
+from bubblechamber import stats
+from bubblechamber import tree
+
+top_n = 10
+
+BC_QUERY_CACHE_HIT = Counter('bc_query_cache_hit_count', 'Stats queries answered from cache')
+BC_QUERY_CACHE_MISS = Counter('bc_query_cache_miss_count', 'Stats queries sent to databases')
+
+
+def __load_config(debug):
+    config_file = 'config.yml'
+    if 'BC_CONFIG' in os.environ:
+            config_file = os.environ['BC_CONFIG']
+
+    config = {}
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as ymlfile:
+            config = yaml.load(ymlfile)
+
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if 'AUTH_SECRET' in os.environ:
+        config['auth']['secret'] = os.environ['AUTH_SECRET']
+    if 'AUTH_DISABLE' in os.environ:
+        config['auth']['enable'] = False
+
+    if os.environ.get('BC_MYSQL_URL', None):
+        config['mysql']['url'] = os.environ['BC_MYSQL_URL']
+
+    if 'INFLUXDB_HOST' in os.environ:
+        config['influxdb']['host'] = os.environ['INFLUXDB_HOST']
+    if 'INFLUXDB_PORT' in os.environ:
+        config['influxdb']['port'] = int(os.environ['INFLUXDB_PORT'])
+    if 'INFLUXDB_DB' in os.environ:
+        config['influxdb']['db'] = os.environ['INFLUXDB_DB']
+    if 'INFLUXDB_USER' in os.environ:
+        config['influxdb']['user'] = os.environ['INFLUXDB_USER']
+    if 'INFLUXDB_PASSWORD' in os.environ:
+        config['influxdb']['password'] = os.environ['INFLUXDB_PASSWORD']
+
+    return config
+
+
+class AsyncQueryCache(QueryCache):
+    '''
+    QueryCache of coroutine results, concurrent misses of a same key
+    wait for the future of the first one
+    '''
+
+    async def get(self, key, ttl, compute):
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hit()
+            return entry[0]
+        # pending queries are futures instead of thread events
+        pending = self.pending.get(key, None)
+        if pending is not None:
+            self.hit()
+            return await asyncio.shield(pending)
+        self.miss()
+        pending = asyncio.ensure_future(compute())
+        self.pending[key] = pending
+        try:
+            result = await asyncio.shield(pending)
+            self.cache.set(key, (result,), ttl)
+            return result
+        finally:
+            self.pending.pop(key, None)
+
+
+class StatsBackend(object):
+    '''
+    Async queries of container procs, files and stats
+    '''
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.session = None
+        self.pool = None
+        self.containers = LRUCache(
+            maxsize=cfg['web'].get('container_cache_size', 10000),
+            ttl=cfg['web'].get('container_cache_ttl', 10)
+        )
+        self.query_cache = AsyncQueryCache(
+            maxsize=cfg['web'].get('query_cache_size', 1000),
+            hits=BC_QUERY_CACHE_HIT,
+            misses=BC_QUERY_CACHE_MISS
+        )
+
+    async def start(self, app):
+        url = make_url(self.cfg['mysql']['url'])
+        self.pool = await aiomysql.create_pool(
+            host=url.host,
+            port=url.port or 3306,
+            user=url.username,
+            password=url.password or '',
+            db=url.database,
+            minsize=1,
+            maxsize=self.cfg['mysql'].get('pool_size', 10),
+            autocommit=True
+        )
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.cfg['influxdb'].get('timeout', 60)),
+            connector=aiohttp.TCPConnector(limit=self.cfg['influxdb'].get('pool_size', 100))
+        )
+
+    async def stop(self, app):
+        if self.session is not None:
+            await self.session.close()
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+    async def __sql(self, query, args):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, args)
+                return await cursor.fetchall()
+
+    async def influx_query(self, query, epoch=None):
+        params = {
+            'db': self.cfg['influxdb']['db'],
+            'q': query
+        }
+        if self.cfg['influxdb'].get('user', None):
+            params['u'] = self.cfg['influxdb']['user']
+            params['p'] = self.cfg['influxdb']['password']
+        if epoch:
+            params['epoch'] = epoch
+        url = 'http://%s:%d/query' % (self.cfg['influxdb']['host'], self.cfg['influxdb'].get('port', 8086))
+        async with self.session.get(url, params=params) as resp:
+            content = await resp.json()
+            if resp.status != 200 or 'error' in content:
+                raise Exception('Influxdb query failed: %s' % (content.get('error', resp.status)))
+        results = content.get('results', [])
+        if not results:
+            return {}
+        if 'error' in results[0]:
+            raise Exception('Influxdb query failed: %s' % (results[0]['error']))
+        return results[0]
+
+    async def last_updated(self, container):
+        entry = self.containers.get(container)
+        if entry is not None:
+            return entry[0]
+        rows = await self.__sql('SELECT last_updated FROM containers WHERE container = %s', (container,))
+        last_updated = None
+        if rows:
+            last_updated = rows[0][0]
+        self.containers.set(container, (last_updated,))
+        return last_updated
+
+    async def select_procs(self, container):
+        result = {'data': []}
+        rows = await self.__sql(
+            'SELECT process_id, exe, arguments, name, parent_id, is_root, last_updated FROM processes WHERE container = %s ORDER BY last_updated',
+            (container,))
+        for row in rows:
+            result['data'].append({
+                'id': row[0],
+                'exe': row[1],
+                'args': row[2],
+                'name': row[3],
+                'parent': row[4],
+                'is_root': bool(row[5]),
+                'last_updated': row[6]
+            })
+        return result
+
+    async def select_tree(self, container, root=None, depth=3, offset=0, limit=100, interval='s'):
+        '''
+        Return a page of children of root (or of root processes), with their
+        descendants down to depth and up to limit children per process
+        '''
+        key = ('tree', container, root, depth, offset, limit, interval)
+        return await self.query_cache.get(
+            key,
+            aligned_ttl(influx.GROUP_SECONDS[interval]),
+            lambda: self.__query_tree(container, root, depth, offset, limit, interval)
+        )
+
+    async def __query_tree(self, container, root, depth, offset, limit, interval):
+        result = {'root': root, 'depth': depth, 'offset': offset, 'limit': limit, 'total': 0, 'data': []}
+        rows = await self.__sql('SELECT process_id, parent_id FROM processes WHERE container = %s', (container,))
+        parents = dict(rows)
+        (children, total, nodes) = tree.select(parents, root, offset, limit, depth)
+        if nodes is None:
+            return result
+        result['total'] = total
+        # io of returned subtrees only
+        io = {}
+        subtree = sorted(tree.descendants(children, [node['id'] for node in nodes]))
+        for i in range(0, len(subtree), 500):
+            chunk = subtree[i:i + 500]
+            rows = await self.__sql(
+                'SELECT process_id, SUM(io_total) FROM files WHERE container = %%s AND process_id IN (%s) GROUP BY process_id' % (', '.join(['%s'] * len(chunk))),
+                [container] + chunk)
+            for (proc_id, io_total) in rows:
+                io[proc_id] = int(io_total or 0)
+        details = {}
+        proc_ids = [node['id'] for node in tree.iter_nodes(nodes)]
+        for i in range(0, len(proc_ids), 500):
+            chunk = proc_ids[i:i + 500]
+            rows = await self.__sql(
+                'SELECT process_id, exe, arguments, name, parent_id, is_root, last_updated FROM processes WHERE container = %%s AND process_id IN (%s)' % (', '.join(['%s'] * len(chunk))),
+                [container] + chunk)
+            for row in rows:
+                details[row[0]] = {
+                    'exe': row[1],
+                    'args': row[2],
+                    'name': row[3],
+                    'parent': row[4],
+                    'is_root': bool(row[5]),
+                    'last_updated': row[6]
+                }
+        cpu = {}
+        last_updated = await self.last_updated(container)
+        if last_updated is not None:
+            (start_time, up_to) = stats.window(last_updated, interval)
+            query = influx.proc_totals_query(influx.CPU, 'duration', interval, container, start_time, up_to)
+            cpu = stats.proc_totals(await self.influx_query(query, epoch='s'))
+        tree.annotate(nodes, details, tree.inclusive_totals(parents, children, cpu), tree.inclusive_totals(parents, children, io))
+        result['data'] = nodes
+        return result
+
+    async def select_files(self, container):
+        result = {}
+        rows = await self.__sql(
+            'SELECT name, process_id, io_in, io_out, io_total, last_updated FROM files WHERE container = %s ORDER BY last_updated',
+            (container,))
+        for row in rows:
+            if row[1] not in result:
+                result[row[1]] = []
+            result[row[1]].append(stats.file_entry(*row))
+        return result
+
+    async def select_files_page(self, container, sort='io_total', limit=100, cursor=None):
+        '''
+        Return a page of files of container, by decreasing sort column, and cursor of next page
+        '''
+        # sort is one of stats.FILE_SORTS
+        query = 'SELECT name, process_id, io_in, io_out, io_total, last_updated FROM files WHERE container = %s'
+        args = [container]
+        if cursor is not None:
+            (value, process_id, name) = cursor
+            query += ' AND (%s < %%s OR (%s = %%s AND (process_id < %%s OR (process_id = %%s AND name < %%s))))' % (sort, sort)
+            args += [value, value, process_id, process_id, name]
+        query += ' ORDER BY %s DESC, process_id DESC, name DESC LIMIT %%s' % (sort)
+        args.append(limit + 1)
+        rows = await self.__sql(query, args)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = stats.file_entry(*rows[-1])
+            next_cursor = stats.encode_cursor((last[sort], last['proc_id'], last['file_name']))
+        return {'cursor': next_cursor, 'data': [stats.file_entry(*row) for row in rows]}
+
+    async def stream_files(self, container, batch=1000):
+        '''
+        Yield batches of files of container in primary key order, read from a server side cursor
+        '''
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(
+                    'SELECT name, process_id, io_in, io_out, io_total, last_updated FROM files WHERE container = %s ORDER BY process_id, name',
+                    (container,))
+                while True:
+                    rows = await cursor.fetchmany(batch)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def select_stats(self, container, measurement, field_name, interval='s', proc_id=None, top=10, tags=None, columnar=False, since=None):
+        '''
+        Return stats time series of a proc, or of the top procs of container
+        '''
+        key = (container, measurement, interval, top, proc_id, tuple(sorted((tags or {}).items())), columnar, since)
+        return await self.query_cache.get(
+            key,
+            aligned_ttl(influx.GROUP_SECONDS[interval]),
+            lambda: self.__query_stats(container, measurement, field_name, interval, proc_id, top, tags, columnar, since)
+        )
+
+    async def __query_stats(self, container, measurement, field_name, interval, proc_id, top, tags, columnar, since):
+        last_updated = await self.last_updated(container)
+        if last_updated is None:
+            return {}
+        (start_time, up_to) = stats.window(last_updated, interval, since)
+        tags = dict(tags or {})
+        if proc_id:
+            tags['proc'] = proc_id
+        else:
+            query = influx.top_procs_query(measurement, interval, container, start_time, up_to, top, tags)
+            tags['proc'] = stats.top_procs(await self.influx_query(query))
+            if not tags['proc']:
+                return {}
+        query = influx.stats_query(measurement, interval, container, start_time, up_to, tags)
+        return stats.decode_series(await self.influx_query(query, epoch='s'), field_name, columnar)
+
+    async def select_cpu(self, container, proc_id=None, interval='s', top=10, columnar=False, since=None):
+        return await self.select_stats(container, influx.CPU, 'duration', interval=interval, proc_id=proc_id, top=top, columnar=columnar, since=since)
+
+    async def select_mem(self, container, interval='s', top=10, columnar=False, since=None):
+        return await self.select_stats(container, influx.MEM, 'vm_size', interval=interval, top=top, columnar=columnar, since=since)
+
+    async def select_io_ts(self, container, proc_id=None, interval='s', system=False, top=10, columnar=False, since=None):
+        # same as bc_web_record, system files are always included
+        return await self.select_stats(container, influx.IO, 'bytes', interval=interval, proc_id=proc_id, top=top, columnar=columnar, since=since)
+
+
+class ReadApi(object):
+    '''
+    Handlers of read api
+    '''
+
+    def __init__(self, cfg, backend):
+        self.cfg = cfg
+        self.backend = backend
+
+    def check_auth(self, request, container_id):
+        if not self.cfg['auth']['enable']:
+            return True
+        if 'Authorization' not in request.headers:
+            return False
+        (bearer, token) = request.headers['Authorization'].split(' ')
+        if bearer != 'token':
+            return False
+        data = None
+        try:
+            data = jwt.decode(token, self.cfg['auth']['secret'], audience='urn:cb/stat')
+        except Exception:
+            return False
+        if data and 'container' in data and data['container'] == container_id:
+            return True
+        return False
+
+    def __get_args(self, request):
+        '''
+        Return (interval, top, format, since, error response) of stats request
+        '''
+        interval = request.query.get('interval', 's')
+        if interval not in influx.GROUP_INTERVALS:
+            return (None, None, None, None, web.Response(status=400, text='invalid interval'))
+        top = int(request.query.get('top', top_n))
+        stats_format = request.query.get('format', 'json')
+        if stats_format not in stats.FORMATS:
+            return (None, None, None, None, web.Response(status=400, text='unsupported format'))
+        if stats_format == 'msgpack' and msgpack is None:
+            return (None, None, None, None, web.Response(status=406, text='msgpack format not supported'))
+        since = request.query.get('since', None)
+        if since is not None:
+            try:
+                since = float(since)
+            except ValueError:
+                return (None, None, None, None, web.Response(status=400, text='invalid since'))
+            if math.isinf(since) or math.isnan(since):
+                return (None, None, None, None, web.Response(status=400, text='invalid since'))
+        return (interval, top, stats_format, since, None)
+
+    def __json_default(self, value):
+        if isinstance(value, datetime.datetime):
+            # same format as flask jsonify
+            return email.utils.formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+        raise TypeError('%s is not JSON serializable' % (type(value)))
+
+    def __response(self, result, stats_format='json'):
+        if stats_format == 'msgpack':
+            return web.Response(body=msgpack.packb(result, use_bin_type=True, default=str), content_type='application/x-msgpack')
+        return web.Response(text=json.dumps(result, default=self.__json_default), content_type='application/json')
+
+    async def ping(self, request):
+        return self.__response({'msg': 'pong'})
+
+    async def metrics(self, request):
+        return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    async def cpu(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        (interval, top, stats_format, since, error) = self.__get_args(request)
+        if error:
+            return error
+        result = await self.backend.select_cpu(cid, proc_id=request.match_info.get('proc_id', None), interval=interval, top=top, columnar=stats_format != 'json', since=since)
+        return self.__response(stats.payload(result, since), stats_format)
+
+    async def mem(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        (interval, top, stats_format, since, error) = self.__get_args(request)
+        if error:
+            return error
+        result = await self.backend.select_mem(cid, interval=interval, top=top, columnar=stats_format != 'json', since=since)
+        return self.__response(stats.payload(result, since), stats_format)
+
+    async def io(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        (interval, top, stats_format, since, error) = self.__get_args(request)
+        if error:
+            return error
+        if 'interval' not in request.query:
+            # files list is not a time series
+            if 'limit' in request.query or 'cursor' in request.query or 'sort' in request.query:
+                return await self.__files_page(request, cid, stats_format)
+            if stats_format == 'json':
+                return await self.__stream_files(request, cid)
+            return self.__response(await self.backend.select_files(cid), stats_format)
+        system = request.query.get('system', None) == 'true'
+        result = await self.backend.select_io_ts(cid, interval=interval, system=system, top=top, columnar=stats_format != 'json', since=since)
+        return self.__response(stats.payload(result, since), stats_format)
+
+    async def __files_page(self, request, cid, stats_format):
+        sort = request.query.get('sort', 'io_total')
+        if sort not in stats.FILE_SORTS:
+            return web.Response(status=400, text='unsupported sort')
+        try:
+            limit = min(max(int(request.query.get('limit', 100)), 1), 1000)
+        except ValueError:
+            return web.Response(status=400, text='invalid limit')
+        cursor = request.query.get('cursor', None)
+        if cursor is not None:
+            cursor = stats.decode_cursor(cursor)
+            if cursor is None:
+                return web.Response(status=400, text='invalid cursor')
+        return self.__response(await self.backend.select_files_page(cid, sort=sort, limit=limit, cursor=cursor), stats_format)
+
+    async def __stream_files(self, request, cid):
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        current = None
+        async for rows in self.backend.stream_files(cid):
+            chunk = [] if current is not None else ['{']
+            for row in rows:
+                entry = stats.file_entry(*row)
+                if entry['proc_id'] != current:
+                    if current is not None:
+                        chunk.append('],')
+                    chunk.append(json.dumps(str(entry['proc_id'])) + ':[')
+                    current = entry['proc_id']
+                else:
+                    chunk.append(',')
+                chunk.append(json.dumps(entry, default=self.__json_default))
+            await response.write(''.join(chunk).encode('utf-8'))
+        if current is None:
+            await response.write(b'{')
+        else:
+            await response.write(b']')
+        await response.write(b'}')
+        await response.write_eof()
+        return response
+
+    async def proc(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        return self.__response(await self.backend.select_procs(cid))
+
+    async def tree(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        (interval, top, stats_format, since, error) = self.__get_args(request)
+        if error:
+            return error
+        try:
+            root = request.query.get('root', None)
+            if root is not None:
+                root = int(root)
+            depth = min(max(int(request.query.get('depth', 3)), 1), 20)
+            offset = max(int(request.query.get('offset', 0)), 0)
+            limit = min(max(int(request.query.get('limit', 100)), 1), 1000)
+        except ValueError:
+            return web.Response(status=400, text='invalid parameter')
+        return self.__response(await self.backend.select_tree(cid, root=root, depth=depth, offset=offset, limit=limit, interval=interval))
+
+    async def summary(self, request):
+        cid = request.match_info['cid']
+        if not self.check_auth(request, cid):
+            return web.Response(status=401, text='not authorized')
+        (interval, top, stats_format, since, error) = self.__get_args(request)
+        if error:
+            return error
+        system = request.query.get('system', None) == 'true'
+        columnar = stats_format != 'json'
+        (procs, cpu, mem, io) = await asyncio.gather(
+            self.backend.select_procs(cid),
+            self.backend.select_cpu(cid, interval=interval, top=top, columnar=columnar, since=since),
+            self.backend.select_mem(cid, interval=interval, top=top, columnar=columnar, since=since),
+            self.backend.select_io_ts(cid, interval=interval, system=system, top=top, columnar=columnar, since=since)
+        )
+        result = {
+            'proc': procs,
+            'cpu': stats.payload(cpu, since),
+            'mem': stats.payload(mem, since),
+            'io': stats.payload(io, since)
+        }
+        return self.__response(result, stats_format)
+
+
+def create_app(cfg):
+    backend = StatsBackend(cfg)
+    api = ReadApi(cfg, backend)
+    app = web.Application()
+    app.on_startup.append(backend.start)
+    app.on_cleanup.append(backend.stop)
+    app.router.add_get('/ping', api.ping)
+    app.router.add_get('/metrics', api.metrics)
+    app.router.add_get('/container/{cid}/cpu/{proc_id}', api.cpu)
+    app.router.add_get('/container/{cid}/cpu', api.cpu)
+    app.router.add_get('/container/{cid}/mem', api.mem)
+    app.router.add_get('/container/{cid}/io', api.io)
+    app.router.add_get('/container/{cid}/proc', api.proc)
+    app.router.add_get('/container/{cid}/summary', api.summary)
+    app.router.add_get('/container/{cid}/tree', api.tree)
+    return app
+
+
+@click.command()
+@click.option('--host', help="listen address", default='0.0.0.0')
+@click.option('--port', help="listen port", default=8001)
+@click.option('--debug', help="set log level to debug", is_flag=True)
+def run(host, port, debug):
+    cfg = __load_config(debug)
+    web.run_app(create_app(cfg), host=host, port=port)
+
+
+if __name__ == '__main__':
+    run()
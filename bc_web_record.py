@@ -1,14 +1,23 @@
 from flask import Flask
 from flask import request
+from flask import Response
 from flask import Blueprint
+from flask import current_app
+from flask import stream_with_context
+from flask import json as flask_json
 from flask.json import jsonify
-from flask import g
 import os
 import json
 import logging
+import math
 import sys
 import datetime
 import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
 import yaml
@@ -21,19 +30,39 @@ from prometheus_client import CollectorRegistry
 
 import consul
 import pika
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 import influxdb
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func
+from sqlalchemy import and_, or_
 
 from bubblechamber.model import ApiKey as BCApiKey
 from bubblechamber.model import Process as BCProcess
 from bubblechamber.model import File as BCFile
 from bubblechamber.model import Container as BCContainer
+from bubblechamber.publisher import EventPublisher
+from bubblechamber.cache import ApiKeyCache, QueryCache, ContainerCache, aligned_ttl
+from bubblechamber.live import LiveHub
+from bubblechamber import influx
+from bubblechamber import stats
+from bubblechamber import tree
 
 FLASK_REQUEST_LATENCY = Histogram('flask_request_latency_seconds', 'Flask Request Latency',
     ['method', 'endpoint'])
 FLASK_REQUEST_COUNT = Counter('flask_request_count', 'Flask Request Count',
     ['method', 'endpoint', 'http_status'])
+BC_EVENT_REJECTED = Counter('bc_event_rejected_count', 'Events rejected because publish queue is full')
+BC_QUERY_CACHE_HIT = Counter('bc_query_cache_hit_count', 'Stats queries answered from cache')
+BC_QUERY_CACHE_MISS = Counter('bc_query_cache_miss_count', 'Stats queries sent to databases')
 
 def before_request():
     request.start_time = time.time()
@@ -44,40 +73,43 @@ def after_request(response):
     FLASK_REQUEST_COUNT.labels(request.method, request.path, response.status_code).inc()
     return response
 
-config_file = 'config.yml'
-if 'BC_CONFIG' in os.environ:
-        config_file = os.environ['BC_CONFIG']
+def load_config():
+    config_file = 'config.yml'
+    if 'BC_CONFIG' in os.environ:
+            config_file = os.environ['BC_CONFIG']
 
-config = {}
-if os.path.exists(config_file):
-    with open(config_file, 'r') as ymlfile:
-        config = yaml.load(ymlfile)
+    config = {}
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as ymlfile:
+            config = yaml.load(ymlfile)
 
-if 'prefix' not in config['web'] or not config['web']['prefix']:
-    config['web']['prefix'] = '/'
-if 'BC_PREFIX' in os.environ and os.environ['BC_PREFIX']:
-    config['web']['prefix'] = os.environ['BC_PREFIX']
+    if 'prefix' not in config['web'] or not config['web']['prefix']:
+        config['web']['prefix'] = '/'
+    if 'BC_PREFIX' in os.environ and os.environ['BC_PREFIX']:
+        config['web']['prefix'] = os.environ['BC_PREFIX']
 
+    if 'AUTH_SECRET' in os.environ:
+        config['auth']['secret'] = os.environ['AUTH_SECRET']
 
-if 'AUTH_SECRET' in os.environ:
-    config['auth']['secret'] = os.environ['AUTH_SECRET']
+    if 'AUTH_DISABLE' in os.environ:
+        config['auth']['enable'] = False
 
-if 'AUTH_DISABLE' in os.environ:
-    config['auth']['enable'] = False
+    if 'INFLUXDB_HOST' in os.environ:
+        config['influxdb']['host'] = os.environ['INFLUXDB_HOST']
+    if 'INFLUXDB_PORT' in os.environ:
+        config['influxdb']['port'] = int(os.environ['INFLUXDB_PORT'])
+    if 'INFLUXDB_DB' in os.environ:
+        config['influxdb']['db'] = os.environ['INFLUXDB_DB']
+    if 'INFLUXDB_USER' in os.environ:
+        config['influxdb']['user'] = os.environ['INFLUXDB_USER']
+    if 'INFLUXDB_PASSWORD' in os.environ:
+        config['influxdb']['password'] = os.environ['INFLUXDB_PASSWORD']
 
-if 'INFLUXDB_HOST' in os.environ:
-    config['influxdb']['host'] = os.environ['INFLUXBD_HOST']
-if 'INFLUXDB_PORT' in os.environ:
-    config['influxdb']['port'] = int(os.environ['INFLUXBD_PORT'])
-if 'INFLUXDB_DB' in os.environ:
-    config['influxdb']['db'] = os.environ['INFLUXBD_DB']
-if 'INFLUXDB_USER' in os.environ:
-    config['influxdb']['user'] = os.environ['INFLUXBD_HOST']
-if 'INFLUXDB_PASSWORD' in os.environ:
-    config['influxdb']['password'] = os.environ['INFLUXBD_PASSWORD']
+    if os.environ.get('BC_MYSQL_URL', None):
+        config['mysql']['url'] = os.environ['BC_MYSQL_URL']
+    return config
 
-if os.environ.get('BC_MYSQL_URL', None):
-    config['mysql']['url'] = os.environ['BC_MYSQL_URL']
+config = load_config()
 
 
 rabbit = 'localhost'
@@ -90,39 +122,71 @@ if 'RABBITMQ_USER' in os.environ and 'RABBITMQ_PASSWORD' in os.environ:
         rabbitmq_user = os.environ['RABBITMQ_USER']
         rabbitmq_password = os.environ['RABBITMQ_PASSWORD']
 
-db_influx = None
-if config['influxdb']['host']:
-    host = config['influxdb']['host']
-    port = config['influxdb'].get('port', 8086)
-    username = config['influxdb']['user']
-    password = config['influxdb']['password']
-    database = config['influxdb']['db']
-db_influx = influxdb.InfluxDBClient(host, port, username, password, database)
-
-connection = None
-if rabbitmq_user:
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(rabbit, credentials=credentials, heartbeat_interval=0))
-else:
-    connection = pika.BlockingConnection(pika.ConnectionParameters(rabbit, heartbeat_interval=0))
-
-channel = connection.channel()
-
-
-sql_engine = create_engine(config['mysql']['url'], pool_pre_ping=True, pool_recycle=3600, echo=config.get('debug', False))
-sql_session_maker = sessionmaker(bind=sql_engine)
+# connections and caches of current process, created on first use so that
+# gunicorn workers do not share sockets or threads of master process
+__resources = {}
+__resources_lock = threading.Lock()
+
+def __resource(name, factory):
+    with __resources_lock:
+        if __resources.get('pid', None) != os.getpid():
+            __resources.clear()
+            __resources['pid'] = os.getpid()
+        if name not in __resources:
+            __resources[name] = factory()
+        return __resources[name]
+
+def __influx():
+    return __resource('influx', lambda: influxdb.InfluxDBClient(
+        config['influxdb']['host'],
+        config['influxdb'].get('port', 8086),
+        config['influxdb']['user'],
+        config['influxdb']['password'],
+        config['influxdb']['db']
+    ))
+
+def __rabbitmq_connect():
+    if rabbitmq_user:
+        credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
+        return pika.BlockingConnection(pika.ConnectionParameters(rabbit, credentials=credentials, heartbeat_interval=0))
+    return pika.BlockingConnection(pika.ConnectionParameters(rabbit, heartbeat_interval=0))
+
+def __publisher():
+    # events are published by a background thread, started on first event
+    return __resource('publisher', lambda: EventPublisher(
+        __rabbitmq_connect,
+        routing_key='bc_record',
+        max_size=config.get('rabbitmq', {}).get('queue_size', 10000),
+        batch_size=config.get('rabbitmq', {}).get('batch_size', 100)
+    ))
+
+def __sql_session():
+    sql_session_maker = __resource('sql', lambda: sessionmaker(bind=create_engine(
+        config['mysql']['url'],
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        echo=config.get('debug', False)
+    )))
+    return sql_session_maker()
 
 def __cassandra_load_api():
     res = []
-    sql_session = sql_session_maker()
-    rows = sql_session.query(BCApiKey).all()
+    sql_session = __sql_session()
+    rows = sql_session.query(BCApiKey.key).all()
     for row in rows:
         res.append(row.key)
     sql_session.close()
     return res
 
-apikeys = __cassandra_load_api()
-# last_check = datetime.datetime.now()
+def __apikeys():
+    # keys are loaded on first event, then refreshed in background
+    return __resource('apikeys', lambda: ApiKeyCache(
+        __cassandra_load_api,
+        refresh=config['auth'].get('apikeys_refresh', 60),
+        min_reload=config['auth'].get('apikeys_min_reload', 10),
+        negative_size=config['auth'].get('apikeys_invalid_size', 10000),
+        negative_ttl=config['auth'].get('apikeys_invalid_ttl', 60)
+    ))
 
 
 top_n = 10
@@ -135,17 +199,19 @@ def consul_declare(config):
         check = consul.Check.http(url='http://' + config['web']['hostname'] + ':' + str(config['web']['port']) + '/ping', interval=60)
         consul_agent.agent.check.register(config['consul']['id'] + '_check', check=check, service_id=config['consul']['id'])
 
-consul_declare(config)
-
-def check_auth(container_id):
+def check_auth(container_id, token=None):
+    '''
+    Check token of authorization header, or token if set
+    '''
     if not config['auth']['enable']:
         return True
     # print(str(request.headers))
-    if 'Authorization' not in request.headers:
-        return False
-    (bearer, token) = request.headers['Authorization'].split(' ')
-    if bearer != 'token':
-        return False
+    if token is None:
+        if 'Authorization' not in request.headers:
+            return False
+        (bearer, token) = request.headers['Authorization'].split(' ')
+        if bearer != 'token':
+            return False
     data = None
     try:
         data = jwt.decode(token, config['auth']['secret'], audience='urn:cb/stat')
@@ -156,27 +222,61 @@ def check_auth(container_id):
         return True
     return False
 
-def __rabbitmq_send_event(event):
-    try:
-        channel.basic_publish(
-            exchange='',
-            routing_key='bc_record',
-            body=json.dumps(event),
-            properties=pika.BasicProperties(
-                # make message persistent
-                delivery_mode=2
-            ))
-    except Exception as e:
-        logging.exception('Failed to send record: ' + str(e))
-
-
-def __influx_query(query):
-    result = db_influx.query(query)
+def __is_event(body):
+    '''
+    Cheap check that body looks like a chisel json event, without decoding it
+    '''
+    if len(body) < 2 or body[:1] != b'{':
+        return False
+    if not body.endswith(b'}') and not body.endswith(b'}\n'):
+        return False
+    return b'"evt_type"' in body
+
+# magic numbers of supported compressed bodies
+CONTENT_ENCODINGS = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd'
+}
+
+def __accept_encoding(encoding):
+    '''
+    zstd events are accepted only if enabled, recorders must then be able to decode them
+    '''
+    if encoding == 'zstd':
+        return zstandard is not None and config['web'].get('zstd', False)
+    return encoding in CONTENT_ENCODINGS
+
+def __is_compressed_event(body, encoding):
+    '''
+    Check that compressed body matches its encoding, body is decoded by recorders
+    '''
+    return body[:len(CONTENT_ENCODINGS[encoding])] == CONTENT_ENCODINGS[encoding]
+
+def __rabbitmq_send_event(body, headers, encoding=None):
+    '''
+    Forward raw event body to recorders, metadata being sent in message headers
+
+    Return False if event could not be queued
+    '''
+    return __publisher().publish(
+        body,
+        pika.BasicProperties(
+            # make message persistent
+            delivery_mode=2,
+            content_type='application/json',
+            content_encoding=encoding,
+            timestamp=int(time.time()),
+            headers=headers
+        ))
+
+
+def __influx_query(query, epoch=None):
+    result = __influx().query(query, epoch=epoch)
     return result.raw
 
 def __select_procs(container):
     result = {'data': []}
-    sql_session = sql_session_maker()
+    sql_session = __sql_session()
     rows = sql_session.query(BCProcess).filter_by(container=container).order_by(BCProcess.last_updated).all()
     for row in rows:
         result['data'].append({
@@ -191,288 +291,278 @@ def __select_procs(container):
     sql_session.close()
     return result
 
-def __cassandra_select_mem(container, interval='s', top=10):
-    sql_session = sql_session_maker()
+def __load_container(container):
+    sql_session = __sql_session()
     cont = sql_session.query(BCContainer).filter_by(container=container).first()
+    sql_session.close()
     if not cont:
-        sql_session.close()
+        return None
+    return cont.last_updated
+
+def __containers():
+    # last update of containers, updated by live stats of watched containers
+    return __resource('containers', lambda: ContainerCache(
+        __load_container,
+        maxsize=config['web'].get('container_cache_size', 10000),
+        ttl=config['web'].get('container_cache_ttl', 10)
+    ))
+
+def __touch_container(container):
+    __containers().touch(container, datetime.datetime.now())
+
+def __hub():
+    # live stats of watched containers, hub thread is started on first viewer
+    return __resource('hub', lambda: LiveHub(
+        __rabbitmq_connect,
+        max_size=config.get('rabbitmq', {}).get('live_queue_size', 100),
+        listener=__touch_container
+    ))
+
+def __select_window(container, interval='s', since=None):
+    '''
+    Return (start_time, up_to) in ns of stats to query for interval,
+    None if container is unknown
+    '''
+    last_updated = __containers().get(container)
+    if last_updated is None:
+        return None
+    return stats.window(last_updated, interval, since)
+
+def __query_cache():
+    # results of stats queries, kept up to the end of their last group interval
+    return __resource('query_cache', lambda: QueryCache(
+        maxsize=config['web'].get('query_cache_size', 1000),
+        hits=BC_QUERY_CACHE_HIT,
+        misses=BC_QUERY_CACHE_MISS
+    ))
+
+def __select_stats(container, measurement, field_name, interval='s', proc_id=None, top=10, tags=None, columnar=False, since=None):
+    '''
+    Return stats time series of a proc, or of the top procs of container
+
+    Top procs are first selected by influxdb, then only their series are fetched.
+    If since is set, only buckets starting at since or later are returned, and top
+    procs are ranked on these buckets.
+    '''
+    key = (container, measurement, interval, top, proc_id, tuple(sorted((tags or {}).items())), columnar, since)
+    return __query_cache().get(
+        key,
+        aligned_ttl(influx.GROUP_SECONDS[interval]),
+        lambda: __query_stats(container, measurement, field_name, interval, proc_id, top, tags, columnar, since)
+    )
+
+def __query_stats(container, measurement, field_name, interval, proc_id, top, tags, columnar, since):
+    window = __select_window(container, interval, since)
+    if window is None:
         return {}
-    cont_last_updated = cont.last_updated
+    (start_time, up_to) = window
+    tags = dict(tags or {})
+    if proc_id:
+        tags['proc'] = proc_id
+    else:
+        query = influx.top_procs_query(measurement, interval, container, start_time, up_to, top, tags)
+        tags['proc'] = stats.top_procs(__influx_query(query))
+        if not tags['proc']:
+            return {}
+    query = influx.stats_query(measurement, interval, container, start_time, up_to, tags)
+    return stats.decode_series(__influx_query(query, epoch='s'), field_name, columnar)
+
+def __select_tree(container, root=None, depth=3, offset=0, limit=100, interval='s'):
+    '''
+    Return a page of children of root (or of root processes), with their
+    descendants down to depth and up to limit children per process
+
+    Each node has cpu and io totals of its subtree
+    '''
+    key = ('tree', container, root, depth, offset, limit, interval)
+    return __query_cache().get(
+        key,
+        aligned_ttl(influx.GROUP_SECONDS[interval]),
+        lambda: __query_tree(container, root, depth, offset, limit, interval)
+    )
+
+def __query_tree(container, root, depth, offset, limit, interval):
+    result = {'root': root, 'depth': depth, 'offset': offset, 'limit': limit, 'total': 0, 'data': []}
+    sql_session = __sql_session()
+    # read from (container, parent_id) index only
+    parents = dict(sql_session.query(BCProcess.process_id, BCProcess.parent_id).filter_by(container=container).all())
     sql_session.close()
-    rows = []
-    result = {}
-    table = 'cpu';
-    table_all = 'cpu_all'
-    group_interval = '10s'
-    start_time = cont.last_updated - datetime.timedelta(seconds=3600)
-    if interval == 'm':
-        table = 'cpu_per_m';
-        table_all = 'cpu_all_per_m'
-        group_interval = '60s'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24)
-    if interval == 'h':
-        table = 'cpu_per_h';
-        table_all = 'cpu_all_per_h'
-        group_interval = '1h'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*2)
-    if interval == 'd':
-        table = 'cpu_per_d';
-        table_all = 'cpu_all_per_d'
-        group_interval = '1d'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*120)
-
-    logging.debug('Query stats after ' + str(start_time))
-    start_time = time.mktime(start_time.timetuple()) * 1000000000
-    up_to = time.mktime(cont_last_updated.timetuple()) * 1000000000
-    query = 'select MAX("bytes") from "bc:container:%s:mem:vm_size" where time >= %d and time <= %d group by time(%s),"proc";' % (container, start_time, up_to, group_interval)
-    # logging.error(str(query))
-    res = __influx_query(query)
-    # logging.error(json.dumps(res))
-    series = res.get('series', None)
-    top_procs = {}
-    tmp_result = {}
-    if not series:
-        return tmp_result
-
-    for serie in series:
-        proc_id = serie['tags']['proc']
-        values = serie['values']
-        for value in values:
-            utc_dt = datetime.datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ')
-            timestamp = (utc_dt - datetime.datetime(1970, 1, 1)).total_seconds()
-
-            res = {
-                'proc_name': proc_id,
-                'ts': timestamp,
-                'vm_size': value[1] or 0,
+    (children, total, nodes) = tree.select(parents, root, offset, limit, depth)
+    if nodes is None:
+        return result
+    result['total'] = total
+
+    sql_session = __sql_session()
+    # io of returned subtrees only
+    io = {}
+    subtree = sorted(tree.descendants(children, [node['id'] for node in nodes]))
+    for i in range(0, len(subtree), 500):
+        rows = sql_session.query(BCFile.process_id, func.sum(BCFile.io_total)).filter(
+            BCFile.container == container,
+            BCFile.process_id.in_(subtree[i:i + 500])
+        ).group_by(BCFile.process_id).all()
+        for (proc_id, io_total) in rows:
+            io[proc_id] = int(io_total or 0)
+    # details of returned processes only
+    details = {}
+    proc_ids = [node['id'] for node in tree.iter_nodes(nodes)]
+    for i in range(0, len(proc_ids), 500):
+        rows = sql_session.query(BCProcess).filter(BCProcess.container == container, BCProcess.process_id.in_(proc_ids[i:i + 500])).all()
+        for row in rows:
+            details[row.process_id] = {
+                'exe': row.exe,
+                'args': row.arguments,
+                'name': row.name,
+                'parent': row.parent_id,
+                'is_root': row.is_root,
+                'last_updated': row.last_updated
             }
+    sql_session.close()
 
-            if proc_id not in top_procs:
-                top_procs[proc_id] = 0
-            top_procs[proc_id] += res['vm_size']
-            if res['proc_name'] not in tmp_result:
-                tmp_result[res['proc_name']] = []
-            tmp_result[res['proc_name']].append(res)
-
-    proc_array = []
-    for proc_id in list(top_procs.keys()):
-        proc_array.append({'id': proc_id, 'vm_size': top_procs[proc_id]})
-    proc_array.sort(key=lambda x: x['vm_size'], reverse=True)
-    if len(proc_array) < top:
-        result = tmp_result
-    else:
-        for proc in proc_array[0:top]:
-            result[proc['id']] = tmp_result[proc['id']]
+    cpu = {}
+    window = __select_window(container, interval)
+    if window is not None:
+        (start_time, up_to) = window
+        cpu = stats.proc_totals(__influx_query(influx.proc_totals_query(influx.CPU, 'duration', interval, container, start_time, up_to), epoch='s'))
+    tree.annotate(nodes, details, tree.inclusive_totals(parents, children, cpu), tree.inclusive_totals(parents, children, io))
+    result['data'] = nodes
     return result
 
+def __cassandra_select_mem(container, interval='s', top=10, columnar=False, since=None):
+    return __select_stats(container, influx.MEM, 'vm_size', interval=interval, top=top, columnar=columnar, since=since)
 
-def __cassandra_select_io_ts(container, proc_id, interval='s', system=False, top=10):
-    sql_session = sql_session_maker()
-    cont = sql_session.query(BCContainer).filter_by(container=container).first()
-    if not cont:
-        sql_session.close()
-        return {}
-    cont_last_updated = cont.last_updated
-    sql_session.close()
-    group_interval = '10s'
-    start_time = cont.last_updated - datetime.timedelta(seconds=3600)
-    if interval == 'm':
-        group_interval = '60s'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24)
-    if interval == 'h':
-        group_interval = '1h'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*2)
-    if interval == 'd':
-        group_interval = '1d'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*120)
-    result = {}
-    # "measurement": "bc:container:" + event['container']+ ":fd:io:in"
-    start_time = time.mktime(start_time.timetuple()) * 1000000000
-    up_to = time.mktime(cont_last_updated.timetuple()) * 1000000000
-    system = True
-    if system:
-        query = 'select SUM("bytes") from "bc:container:%s:fd:io:total" where time >= %d and time <= %d group by time(%s),"proc";' % (container, start_time, up_to, group_interval)
-    else:
-        query = 'select SUM("bytes") from "bc:container:%s:fd:io:total" where "system" = 0 and time >= %d and time <= %d group by time(%s),"proc";' % (container, start_time, up_to, group_interval)
-
-    top_procs = {}
-    tmp_result = {}
-    res = __influx_query(query)
-    # logging.error(query)
-    series = res.get('series', None)
-    # logging.error(str(res))
-    if not series:
-        return {}
-
-    for serie in series:
-        # logging.error(json.dumps(serie))
-        if proc_id and proc_id != serie['tags']['proc']:
-            continue
-        proc_id = serie['tags']['proc']
-        values = serie['values']
-        for value in values:
-            utc_dt = datetime.datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ')
-            timestamp = (utc_dt - datetime.datetime(1970, 1, 1)).total_seconds()
-
-            res = {
-                'proc_name': proc_id,
-                'ts': timestamp,
-                'bytes': value[1] or 0,
-            }
-
-            if proc_id not in top_procs:
-                top_procs[proc_id] = 0
-            top_procs[proc_id] += res['bytes']
-            if res['proc_name'] not in tmp_result:
-                tmp_result[res['proc_name']] = []
-            tmp_result[res['proc_name']].append(res)
-
-    proc_array = []
-    for proc_id in list(top_procs.keys()):
-        proc_array.append({'id': proc_id, 'io': top_procs[proc_id]})
-    proc_array.sort(key=lambda x: x['io'], reverse=True)
-    if len(proc_array) < top:
-        result = tmp_result
-    else:
-        for proc in proc_array[0:top]:
-            result[proc['id']] = tmp_result[proc['id']]
-    return result
 
-def __cassandra_select_io(container, proc_id=None, interval=None, system=False, top=10):
+def __cassandra_select_io_ts(container, proc_id, interval='s', system=False, top=10, columnar=False, since=None):
+    system = True
+    tags = None
+    if not system:
+        tags = {'system': '0'}
+    return __select_stats(container, influx.IO, 'bytes', interval=interval, proc_id=proc_id, top=top, tags=tags, columnar=columnar, since=since)
+
+def __file_entry(row):
+    return stats.file_entry(row.name, row.process_id, row.io_in, row.io_out, row.io_total, row.last_updated)
+
+def __select_files_page(container, sort='io_total', limit=100, cursor=None):
+    '''
+    Return a page of files of container, by decreasing sort column, and cursor of next page
+
+    Pages are selected on (sort column, process_id, name) of last file of previous page,
+    so that cost of a page does not depend on its position in listing
+    '''
+    column = getattr(BCFile, sort)
+    sql_session = __sql_session()
+    query = sql_session.query(BCFile).filter_by(container=container)
+    if cursor is not None:
+        (value, process_id, name) = cursor
+        query = query.filter(or_(
+            column < value,
+            and_(column == value, or_(
+                BCFile.process_id < process_id,
+                and_(BCFile.process_id == process_id, BCFile.name < name)
+            ))
+        ))
+    rows = query.order_by(column.desc(), BCFile.process_id.desc(), BCFile.name.desc()).limit(limit + 1).all()
+    sql_session.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = stats.encode_cursor((getattr(rows[-1], sort), rows[-1].process_id, rows[-1].name))
+    return {'cursor': next_cursor, 'data': [__file_entry(row) for row in rows]}
+
+def __stream_files(container, batch=1000):
+    '''
+    Return generator of json files of container, per process, in primary key order
+
+    Rows are read from a server side cursor and sent by batches, so that memory
+    does not depend on number of files
+    '''
+    sql_session = __sql_session()
+    query = sql_session.query(BCFile).filter_by(container=container)
+    query = query.order_by(BCFile.process_id, BCFile.name).execution_options(stream_results=True).yield_per(batch)
+
+    def generate():
+        try:
+            chunk = ['{']
+            current = None
+            for row in query:
+                if row.process_id != current:
+                    if current is not None:
+                        chunk.append('],')
+                    chunk.append(json.dumps(str(row.process_id)) + ':[')
+                    current = row.process_id
+                else:
+                    chunk.append(',')
+                chunk.append(flask_json.dumps(__file_entry(row)))
+                if len(chunk) >= batch:
+                    yield ''.join(chunk)
+                    chunk = []
+            if current is not None:
+                chunk.append(']')
+            chunk.append('}')
+            yield ''.join(chunk)
+        finally:
+            sql_session.close()
+    return generate()
+
+def __cassandra_select_io(container, interval=None, system=False, top=10, columnar=False, since=None):
     result = {}
     if interval is None:
-        sql_session = sql_session_maker()
-        rows = sql_session.query(BCFile).filter_by(container=container).order_by(BCFile.last_updated).all()
-        for row in rows:
-            if proc_id and proc_id!=row.proc_id:
-                continue
+        sql_session = __sql_session()
+        for row in sql_session.query(BCFile).filter_by(container=container).order_by(BCFile.last_updated).all():
             if row.process_id not in result:
                 result[row.process_id] = []
-            result[row.process_id].append({
-                'file_name': row.name,
-                'proc_id': row.process_id,
-                'io_in': row.io_in,
-                'io_out': row.io_out,
-                'io_total': row.io_total,
-                'last_updated': row.last_updated
-            })
-        sql_session.close()
-    else:
-        result = __cassandra_select_io_ts(container, proc_id, interval, system, top)
-    return result
-
-def __cassandra_select_cpu(container, proc_id=None, interval='s', top=10):
-    sql_session = sql_session_maker()
-    cont = sql_session.query(BCContainer).filter_by(container=container).first()
-    if not cont:
+            result[row.process_id].append(__file_entry(row))
         sql_session.close()
-        return {}
-    cont_last_updated = cont.last_updated
-    sql_session.close()
-    rows = []
-    result = {}
-    group_interval = '10s'
-    start_time = cont.last_updated - datetime.timedelta(seconds=3600)
-    if interval == 'm':
-        group_interval = '60s'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24)
-    if interval == 'h':
-        group_interval = '1h'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*2)
-    if interval == 'd':
-        group_interval = '1d'
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*120)
-
-    if proc_id:
-        start_time = time.mktime(start_time.timetuple()) * 1000000000
-        up_to = time.mktime(cont_last_updated.timetuple()) * 1000000000
-        query = 'select SUM("duration") from "bc:container:%s:cpu:duration" where "proc" = \'%s\' and time >= %d and time <= %d group by time(%s);' % (container, str(proc_id), start_time, up_to, group_interval)
-        # logging.error(str(query))
-        res = __influx_query(query)
-        series = res.get('series', None)
-        # logging.error(str(res))
-        if not series:
-            return {}
-        for serie in series:
-            values = serie['values']
-            for value in values:
-                utc_dt = datetime.datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ')
-                timestamp = (utc_dt - datetime.datetime(1970, 1, 1)).total_seconds()
-                res = {
-                    'proc_name': proc_id,
-                    'ts': timestamp,
-                    'duration': value[1] or 0,
-                }
-
-                if res['proc_name'] not in result:
-                    result[res['proc_name']] = []
-                result[res['proc_name']].append(res)
     else:
-        logging.debug('Query stats after ' + str(start_time))
-        start_time = time.mktime(start_time.timetuple()) * 1000000000
-        up_to = time.mktime(cont_last_updated.timetuple()) * 1000000000
-        query = 'select SUM("duration") from "bc:container:%s:cpu:duration" where time >= %d and time <= %d group by time(%s),"proc";' % (container, start_time, up_to, group_interval)
-        # logging.error(str(query))
-        res = __influx_query(query)
-        # logging.error(json.dumps(res))
-        series = res.get('series', None)
-        top_procs = {}
-        tmp_result = {}
-        if not series:
-            return tmp_result
-
-        for serie in series:
-            proc_id = serie['tags']['proc']
-            values = serie['values']
-            for value in values:
-                utc_dt = datetime.datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ')
-                timestamp = (utc_dt - datetime.datetime(1970, 1, 1)).total_seconds()
-
-                res = {
-                    'proc_name': proc_id,
-                    'ts': timestamp,
-                    'duration': value[1] or 0,
-                }
-
-                if proc_id not in top_procs:
-                    top_procs[proc_id] = 0
-                top_procs[proc_id] += res['duration']
-                if res['proc_name'] not in tmp_result:
-                    tmp_result[res['proc_name']] = []
-                tmp_result[res['proc_name']].append(res)
-
-        proc_array = []
-        for proc_id in list(top_procs.keys()):
-            proc_array.append({'id': proc_id, 'duration': top_procs[proc_id]})
-        proc_array.sort(key=lambda x: x['duration'], reverse=True)
-        if len(proc_array) < top:
-            result = tmp_result
-        else:
-            for proc in proc_array[0:top]:
-                result[proc['id']] = tmp_result[proc['id']]
+        result = __cassandra_select_io_ts(container, None, interval, system, top, columnar, since)
     return result
 
-app = Flask(__name__)
-app.before_request(before_request)
-app.after_request(after_request)
-#logging.warn("Using prefix " + str(config['web']['prefix']))
-#bp = Blueprint('frontend', __name__)
-#app.register_blueprint(bp, url_prefix=config['web']['prefix'])
-
-@app.route('/ping', methods=['GET'])
+def __cassandra_select_cpu(container, proc_id=None, interval='s', top=10, columnar=False, since=None):
+    return __select_stats(container, influx.CPU, 'duration', interval=interval, proc_id=proc_id, top=top, columnar=columnar, since=since)
+
+def __get_stats_args():
+    '''
+    Return (format, since, error response) of stats request
+    '''
+    stats_format = request.args.get('format')
+    if stats_format is None:
+        stats_format = 'json'
+    if stats_format not in stats.FORMATS:
+        return (None, None, ("unsupported format", 400))
+    if stats_format == 'msgpack' and msgpack is None:
+        return (None, None, ("msgpack format not supported", 406))
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return (None, None, ("invalid since", 400))
+        if math.isinf(since) or math.isnan(since):
+            return (None, None, ("invalid since", 400))
+    return (stats_format, since, None)
+
+def __stats_response(result, stats_format, since=None):
+    result = stats.payload(result, since)
+    if stats_format == 'msgpack':
+        return Response(msgpack.packb(result, use_bin_type=True, default=str), mimetype='application/x-msgpack')
+    return jsonify(result)
+
+bp = Blueprint('bubblechamber', __name__)
+
+@bp.route('/ping', methods=['GET'])
 def ping():
-    logging.warn(str(app.url_map))
+    logging.warn(str(current_app.url_map))
 
     return jsonify({'msg': 'pong'})
 
 
-@app.route('/metrics', methods=['GET'])
+@bp.route('/metrics', methods=['GET'])
 def metrics():
     registry = CollectorRegistry()
     multiprocess.MultiProcessCollector(registry)
     return generate_latest(registry)
 
-@app.route("/container/<cid>/cpu/<proc_id>")
+@bp.route("/container/<cid>/cpu/<proc_id>")
 def container_cpu(cid, proc_id):
     res = check_auth(cid)
     if not res:
@@ -480,9 +570,14 @@ def container_cpu(cid, proc_id):
     interval = request.args.get('interval')
     if interval is None:
         interval = 's'
-    return jsonify(__cassandra_select_cpu(cid, proc_id, interval=interval))
-
-@app.route("/container/<cid>/cpu")
+    if interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
+    (stats_format, since, error) = __get_stats_args()
+    if error:
+        return error
+    return __stats_response(__cassandra_select_cpu(cid, proc_id, interval=interval, columnar=stats_format != 'json', since=since), stats_format, since)
+
+@bp.route("/container/<cid>/cpu")
 def container_cpus(cid):
     res = check_auth(cid)
     if not res:
@@ -490,22 +585,48 @@ def container_cpus(cid):
     interval = request.args.get('interval')
     if interval is None:
         interval = 's'
+    if interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
     top_res = request.args.get('top')
     if top_res is None:
         top_res = top_n
     else:
         top_res = int(top_res)
-    return jsonify(__cassandra_select_cpu(cid, interval=interval, top=top_res))
+    (stats_format, since, error) = __get_stats_args()
+    if error:
+        return error
+    return __stats_response(__cassandra_select_cpu(cid, interval=interval, top=top_res, columnar=stats_format != 'json', since=since), stats_format, since)
 
 
-@app.route("/container/<cid>/proc")
+@bp.route("/container/<cid>/proc")
 def container_procs(cid):
     res = check_auth(cid)
     if not res:
         return "not authorized", 401
     return jsonify(__select_procs(cid))
 
-@app.route("/container/<cid>/mem")
+@bp.route("/container/<cid>/tree")
+def container_tree(cid):
+    res = check_auth(cid)
+    if not res:
+        return "not authorized", 401
+    interval = request.args.get('interval')
+    if interval is None:
+        interval = 's'
+    if interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
+    try:
+        root = request.args.get('root')
+        if root is not None:
+            root = int(root)
+        depth = min(max(int(request.args.get('depth', 3)), 1), 20)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return "invalid parameter", 400
+    return jsonify(__select_tree(cid, root=root, depth=depth, offset=offset, limit=limit, interval=interval))
+
+@bp.route("/container/<cid>/mem")
 def container_mem(cid):
     res = check_auth(cid)
     if not res:
@@ -513,20 +634,27 @@ def container_mem(cid):
     interval = request.args.get('interval')
     if interval is None:
         interval = 's'
+    if interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
     top_res = request.args.get('top')
     if top_res is None:
         top_res = top_n
     else:
         top_res = int(top_res)
-    return jsonify(__cassandra_select_mem(cid, interval=interval, top=top_res))
+    (stats_format, since, error) = __get_stats_args()
+    if error:
+        return error
+    return __stats_response(__cassandra_select_mem(cid, interval=interval, top=top_res, columnar=stats_format != 'json', since=since), stats_format, since)
 
 
-@app.route("/container/<cid>/io")
+@bp.route("/container/<cid>/io")
 def container_io(cid):
     res = check_auth(cid)
     if not res:
         return "not authorized", 401
     interval = request.args.get('interval')
+    if interval is not None and interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
     system = request.args.get('system')
     if system == 'true':
         system = True
@@ -537,10 +665,104 @@ def container_io(cid):
         top_res = top_n
     else:
         top_res = int(top_res)
-    return jsonify(__cassandra_select_io(cid, interval=interval, system=system, top=top_res))
-
-
-@app.route("/event", methods=['POST'])
+    (stats_format, since, error) = __get_stats_args()
+    if error:
+        return error
+    if interval is None:
+        # files list is not a time series
+        since = None
+        if 'limit' in request.args or 'cursor' in request.args or 'sort' in request.args:
+            sort = request.args.get('sort', 'io_total')
+            if sort not in stats.FILE_SORTS:
+                return "unsupported sort", 400
+            try:
+                limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+            except ValueError:
+                return "invalid limit", 400
+            cursor = request.args.get('cursor')
+            if cursor is not None:
+                cursor = stats.decode_cursor(cursor)
+                if cursor is None:
+                    return "invalid cursor", 400
+            return __stats_response(__select_files_page(cid, sort=sort, limit=limit, cursor=cursor), stats_format)
+        if stats_format == 'json':
+            return Response(stream_with_context(__stream_files(cid)), mimetype='application/json')
+    return __stats_response(__cassandra_select_io(cid, interval=interval, system=system, top=top_res, columnar=stats_format != 'json', since=since), stats_format, since)
+
+
+def __summary_executor():
+    # queries of summary requests, shared by threads of worker
+    return __resource('summary_executor', lambda: ThreadPoolExecutor(
+        max_workers=config['web'].get('summary_workers', 8)
+    ))
+
+@bp.route("/container/<cid>/summary")
+def container_summary(cid):
+    '''
+    Return procs, cpu, mem and io stats of container, queried concurrently
+    '''
+    res = check_auth(cid)
+    if not res:
+        return "not authorized", 401
+    interval = request.args.get('interval')
+    if interval is None:
+        interval = 's'
+    if interval not in influx.GROUP_INTERVALS:
+        return "invalid interval", 400
+    system = request.args.get('system') == 'true'
+    top_res = request.args.get('top')
+    if top_res is None:
+        top_res = top_n
+    else:
+        top_res = int(top_res)
+    (stats_format, since, error) = __get_stats_args()
+    if error:
+        return error
+    columnar = stats_format != 'json'
+    summary_executor = __summary_executor()
+    futures = {
+        'proc': summary_executor.submit(__select_procs, cid),
+        'cpu': summary_executor.submit(__cassandra_select_cpu, cid, interval=interval, top=top_res, columnar=columnar, since=since),
+        'mem': summary_executor.submit(__cassandra_select_mem, cid, interval=interval, top=top_res, columnar=columnar, since=since),
+        'io': summary_executor.submit(__cassandra_select_io_ts, cid, None, interval=interval, system=system, top=top_res, columnar=columnar, since=since)
+    }
+    result = {'proc': futures['proc'].result()}
+    for stat in ['cpu', 'mem', 'io']:
+        result[stat] = stats.payload(futures[stat].result(), since)
+    return __stats_response(result, stats_format)
+
+
+@bp.route("/container/<cid>/live")
+def container_live(cid):
+    # EventSource cannot set headers, token can be given as query parameter
+    res = check_auth(cid, request.args.get('token'))
+    if not res:
+        return "not authorized", 401
+    hub = __hub()
+    messages = hub.subscribe(cid)
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    body = messages.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if isinstance(body, bytes):
+                    body = body.decode('utf-8')
+                yield 'data: %s\n\n' % (body)
+        finally:
+            hub.unsubscribe(cid, messages)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@bp.route("/event", methods=['POST'])
 def get_event_auth_header():
     api = None
     if 'Authorization' in request.headers:
@@ -549,32 +771,57 @@ def get_event_auth_header():
         return "Not authorized", 401
     return get_event(api)
 
-@app.route("/event/api/<api>", methods=['POST'])
+@bp.route("/event/api/<api>", methods=['POST'])
 def get_event(api):
     if config['auth'].get('skip', False) is True:
-        if api not in apikeys:
-            apikeys.append(api)
-    if api not in apikeys:
-        # check if reload necessary
-        new_check = datetime.datetime.now()
-        # if last check > 60s
-        last_check = g.get('last_check', None)
-        if last_check is None or last_check < new_check - datetime.timedelta(seconds=60):
-            logging.debug("Reload api keys")
-            g.last_check = new_check
-            # last_check = new_check
-            __cassandra_load_api()
-        if api not in apikeys:
-            logging.warn("InvalidApiKey:%s" % (str(api)))
-            return "invalid api key", 401
+        __apikeys().add(api)
+    if not __apikeys().is_valid(api):
+        logging.warn("InvalidApiKey:%s" % (str(api)))
+        return "invalid api key", 401
     # print(str(request.data))
-    content = request.get_json(silent=True)
-    __rabbitmq_send_event({'event': content})
+    body = request.get_data(cache=False)
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding == 'identity':
+        encoding = None
+        if not __is_event(body):
+            return "invalid event", 400
+    elif not __accept_encoding(encoding):
+        return "unsupported content encoding", 415
+    elif not __is_compressed_event(body, encoding):
+        return "invalid event", 400
+    # compressed events are forwarded as is
+    if not __rabbitmq_send_event(body, {'api': api}, encoding):
+        BC_EVENT_REJECTED.inc()
+        logging.warn('Event queue is full, reject event')
+        return "event queue full", 503, {'Retry-After': '1'}
     return "ok"
 
+def create_app(cfg=None):
+    '''
+    Create flask application
+
+    Connections to databases and rabbitmq are opened on first use in each
+    process, consul registration is done by gunicorn master (see gunicorn_conf.py)
+    or when running this script.
+    '''
+    if cfg is not None:
+        config.clear()
+        config.update(cfg)
+    with __resources_lock:
+        __resources.clear()
+    #logging.warn("Using prefix " + str(config['web']['prefix']))
+    flask_app = Flask(__name__)
+    flask_app.before_request(before_request)
+    flask_app.after_request(after_request)
+    flask_app.register_blueprint(bp)
+    return flask_app
+
+app = create_app()
+
 if __name__ == "__main__":
     bc_debug = False
     if 'BC_DEBUG' in os.environ:
         bc_debug = True
+    consul_declare(config)
     logging.warn(str(app.url_map))
     app.run(host="0.0.0.0", debug=bc_debug)
@@ -0,0 +1,217 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Key/value cache with a max number of entries (least recently used
+    entries are evicted first) and an optional time to live per entry
+    '''
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return default
+            (value, expires) = entry
+            if expires is not None and expires < time.time():
+                return default
+            self.data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expires)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ApiKeyCache(object):
+    '''
+    Set of valid api keys, reloaded in background every refresh seconds
+
+    An unknown key triggers at most one reload every min_reload seconds, then
+    is kept in a bounded negative cache so that it is rejected without reload
+    '''
+
+    def __init__(self, load, refresh=60, min_reload=10, negative_size=10000, negative_ttl=60):
+        # function returning the list of valid keys
+        self.load = load
+        self.refresh = refresh
+        self.min_reload = min_reload
+        self.keys = frozenset()
+        self.invalid = LRUCache(maxsize=negative_size, ttl=negative_ttl)
+        self.last_load = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        '''
+        Start refresh thread if not already running in current process
+        '''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='bc-apikeys')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh)
+            with self.lock:
+                self.reload()
+
+    def reload(self):
+        try:
+            self.keys = frozenset(self.load())
+            logging.debug('Loaded %d api keys' % (len(self.keys)))
+        except Exception as e:
+            logging.exception('Failed to load api keys: ' + str(e))
+        self.last_load = time.time()
+
+    def add(self, key):
+        if key not in self.keys:
+            self.keys = self.keys | frozenset([key])
+
+    def is_valid(self, key):
+        self.start()
+        if key in self.keys:
+            return True
+        if self.invalid.get(key) is not None:
+            return False
+        with self.lock:
+            if time.time() - self.last_load >= self.min_reload:
+                self.reload()
+        if key in self.keys:
+            return True
+        self.invalid.set(key, True)
+        return False
+
+
+def aligned_ttl(period):
+    '''
+    Return number of seconds up to the end of current period
+    '''
+    return max(1, period - int(time.time()) % period)
+
+
+class QueryCache(object):
+    '''
+    Cache of query results, where concurrent misses of a same key
+    wait for the first one to compute the result (single flight)
+
+    hits and misses are optional prometheus counters
+    '''
+
+    def __init__(self, maxsize=1000, timeout=30, hits=None, misses=None):
+        self.cache = LRUCache(maxsize=maxsize)
+        # max time to wait for a pending query of another thread
+        self.timeout = timeout
+        self.hits = hits
+        self.misses = misses
+        # key => threading.Event of pending queries
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def hit(self):
+        if self.hits is not None:
+            self.hits.inc()
+
+    def miss(self):
+        if self.misses is not None:
+            self.misses.inc()
+
+    def get(self, key, ttl, compute):
+        '''
+        Return cached result of key, else result of compute() cached for ttl seconds
+        '''
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hit()
+            return entry[0]
+        with self.lock:
+            pending = self.pending.get(key, None)
+            if pending is None:
+                self.pending[key] = threading.Event()
+        if pending is not None:
+            pending.wait(self.timeout)
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.hit()
+                return entry[0]
+            # first query failed or is too slow
+            self.miss()
+            return compute()
+        self.miss()
+        try:
+            result = compute()
+            # results are wrapped so that None or empty results are cached too
+            self.cache.set(key, (result,), ttl)
+            return result
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    def clear(self):
+        self.cache.clear()
+
+
+class ContainerCache(object):
+    '''
+    Last update time of containers, loaded on miss and kept ttl seconds
+
+    Unknown containers (load returns None) are kept negative_ttl seconds.
+    touch updates a known container without loading it again.
+    '''
+
+    def __init__(self, load, maxsize=10000, ttl=10, negative_ttl=5):
+        # function returning last update time of a container, None if unknown
+        self.load = load
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def get(self, container):
+        entry = self.cache.get(container)
+        if entry is not None:
+            return entry[0]
+        last_updated = self.load(container)
+        self.cache.set(container, (last_updated,), self.ttl if last_updated is not None else self.negative_ttl)
+        return last_updated
+
+    def touch(self, container, last_updated):
+        entry = self.cache.get(container)
+        if entry is not None and entry[0] is not None and entry[0] >= last_updated:
+            return
+        self.cache.set(container, (last_updated,), self.ttl)
@@ -0,0 +1,59 @@
+'''
+Classification of container ids and cgroup cpusets sent by chisels
+
+Chisels filter and normalise cgroups before sending events, classification
+is still applied to events sent by older chisels.
+'''
+
+# classification of already seen cgroups
+__classified = {}
+MAX_CLASSIFIED = 10000
+
+
+def is_cgroup(data_cgroup):
+    if data_cgroup.startswith('/'):
+        return True
+    else:
+        return False
+
+
+def is_docker(data_cpuset):
+    if '/docker' in data_cpuset:
+        return True
+    return False
+
+
+def is_slurm(data_cpuset):
+    if '/slurm' in data_cpuset:
+        cpuset = data_cpuset.split('/')
+        for fsg in cpuset:
+            if fsg.startswith('job_'):
+                return (True, fsg)
+    return (False, None)
+
+
+def classify(data_cgroup):
+    '''
+    Return (container, is_slurm) for a container id or cgroup cpuset
+
+    container is None if events of this cgroup should be ignored (docker cgroups),
+    slurm cgroups are normalised to their job_XX name
+    '''
+    res = __classified.get(data_cgroup, None)
+    if res is not None:
+        return res
+    res = (data_cgroup, False)
+    if is_cgroup(data_cgroup):
+        if is_docker(data_cgroup):
+            res = (None, False)
+        else:
+            (slurm, cgroup) = is_slurm(data_cgroup)
+            if slurm:
+                res = (cgroup, True)
+    elif data_cgroup.startswith('job_'):
+        # already normalised by chisel
+        res = (data_cgroup, True)
+    if len(__classified) >= MAX_CLASSIFIED:
+        __classified.clear()
+    __classified[data_cgroup] = res
+    return res
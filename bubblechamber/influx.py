@@ -0,0 +1,225 @@
+'''
+InfluxDB schema of container stats
+
+Stats are written in a fixed set of measurements, tagged by container and proc:
+
+ * cpu: duration (cpu time)
+ * mem: vm_size (kB)
+ * io: in, out, total (bytes), system tag is 1 for /etc, /usr and /lib files
+'''
+
+import re
+
+CPU = 'cpu'
+MEM = 'mem'
+IO = 'io'
+MEASUREMENTS = [CPU, MEM, IO]
+
+# previous schema used a set of measurements per container,
+# suffix => (measurement, old field, new field)
+LEGACY_PREFIX = 'bc:container:'
+LEGACY_MEASUREMENTS = {
+    ':cpu:duration': (CPU, 'duration', 'duration'),
+    ':mem:vm_size': (MEM, 'bytes', 'vm_size'),
+    ':fd:io:in': (IO, 'bytes', 'in'),
+    ':fd:io:out': (IO, 'bytes', 'out'),
+    ':fd:io:total': (IO, 'bytes', 'total'),
+}
+
+
+def is_system(file_name):
+    if file_name.startswith('/etc') or file_name.startswith('/usr') or file_name.startswith('/lib'):
+        return 1
+    return 0
+
+
+def quote(value):
+    '''
+    Quote a tag value to be used in a query
+    '''
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def parse_legacy(measurement):
+    '''
+    Return (container, measurement, old field, new field) of a legacy measurement,
+    None if measurement is not a legacy one
+    '''
+    if not measurement.startswith(LEGACY_PREFIX):
+        return None
+    for suffix in LEGACY_MEASUREMENTS:
+        if measurement.endswith(suffix):
+            container = measurement[len(LEGACY_PREFIX):-len(suffix)]
+            (new_measurement, old_field, new_field) = LEGACY_MEASUREMENTS[suffix]
+            return (container, new_measurement, old_field, new_field)
+    return None
+
+
+# rollup tiers, stored in their own retention policy and computed from
+# previous tier: (query interval, retention policy, group interval)
+ROLLUPS = [
+    ('m', 'bc_1m', '1m'),
+    ('h', 'bc_1h', '1h'),
+    ('d', 'bc_1d', '1d'),
+]
+ROLLUP_RETENTIONS = {
+    'bc_1m': '2d',
+    'bc_1h': '120d',
+    'bc_1d': 'INF'
+}
+# tiers computed by recorder when influxdb.rollup is recorder:
+# (retention policy, bucket size in seconds)
+RECORDER_ROLLUPS = [
+    ('bc_1m', 60),
+    ('bc_1h', 3600),
+]
+# aggregate of each field in rollups
+ROLLUP_AGGREGATES = {
+    CPU: [('sum', 'duration')],
+    MEM: [('max', 'vm_size')],
+    IO: [('sum', 'in'), ('sum', 'out'), ('sum', 'total')],
+}
+
+# group interval of queries per requested interval
+GROUP_INTERVALS = {
+    's': '10s',
+    'm': '60s',
+    'h': '1h',
+    'd': '1d'
+}
+GROUP_SECONDS = {
+    's': 10,
+    'm': 60,
+    'h': 3600,
+    'd': 86400
+}
+
+
+def get_retention_policy(interval):
+    '''
+    Return retention policy to query for interval, None for raw stats
+    '''
+    for (rollup_interval, retention_policy, group_interval) in ROLLUPS:
+        if rollup_interval == interval:
+            return retention_policy
+    return None
+
+
+def get_measurement(measurement, interval='s'):
+    '''
+    Return measurement to use in queries for interval
+    '''
+    retention_policy = get_retention_policy(interval)
+    if retention_policy is None:
+        return '"%s"' % (measurement)
+    return '"%s"."%s"' % (retention_policy, measurement)
+
+
+def rollup_queries(database, from_raw=False):
+    '''
+    Return (name, retention policy, select query, group interval) of rollups, each tier being
+    computed from previous one, or from raw stats if from_raw is set
+    '''
+    queries = []
+    # raw stats are in default retention policy
+    source = ''
+    for (rollup_interval, retention_policy, group_interval) in ROLLUPS:
+        for measurement in MEASUREMENTS:
+            fields = ', '.join(['%s("%s") AS "%s"' % (aggregate, field, field) for (aggregate, field) in ROLLUP_AGGREGATES[measurement]])
+            select = 'SELECT %s INTO "%s"."%s"."%s" FROM "%s".%s."%s" GROUP BY time(%s), *' % (
+                fields,
+                database, retention_policy, measurement,
+                database, source, measurement,
+                group_interval
+            )
+            queries.append(('%s_%s' % (retention_policy, measurement), retention_policy, select, group_interval))
+        if not from_raw:
+            source = '"%s"' % (retention_policy)
+    return queries
+
+
+DURATION_UNITS = {
+    'w': 604800,
+    'd': 86400,
+    'h': 3600,
+    'm': 60,
+    's': 1
+}
+
+
+def duration_seconds(duration):
+    '''
+    Return seconds of a retention policy duration (2d, 168h0m0s...), None for infinite ones
+    '''
+    seconds = 0
+    for (value, unit) in re.findall(r'(\d+)([wdhms])', duration):
+        seconds += int(value) * DURATION_UNITS[unit]
+    if not seconds:
+        # INF or 0s
+        return None
+    return seconds
+
+
+# aggregate of each measurement in stat queries, per group interval: (function, field)
+STAT_AGGREGATES = {
+    CPU: ('sum', 'duration'),
+    MEM: ('max', 'vm_size'),
+    IO: ('sum', 'total'),
+}
+
+
+def stat_filter(container, start_time, up_to, tags=None):
+    '''
+    Return where clause of stats of container between start_time and up_to (ns)
+
+    tags is a dict of tag name => value or list of accepted values
+    '''
+    conditions = ['"container" = %s' % (quote(container))]
+    tags = tags or {}
+    for tag in sorted(tags.keys()):
+        values = tags[tag]
+        if isinstance(values, (list, tuple)):
+            conditions.append('(%s)' % (' or '.join(['"%s" = %s' % (tag, quote(value)) for value in values])))
+        else:
+            conditions.append('"%s" = %s' % (tag, quote(values)))
+    conditions.append('time >= %d and time <= %d' % (start_time, up_to))
+    return ' and '.join(conditions)
+
+
+def stats_query(measurement, interval, container, start_time, up_to, tags=None):
+    '''
+    Return query of stats time series of container, per proc
+    '''
+    (aggregate, field) = STAT_AGGREGATES[measurement]
+    return 'select %s("%s") from %s where %s group by time(%s),"proc";' % (
+        aggregate.upper(), field,
+        get_measurement(measurement, interval),
+        stat_filter(container, start_time, up_to, tags),
+        GROUP_INTERVALS[interval]
+    )
+
+
+def top_procs_query(measurement, interval, container, start_time, up_to, top, tags=None):
+    '''
+    Return query of the top procs of container, ranked on the sum of their
+    stats time series values
+    '''
+    (aggregate, field) = STAT_AGGREGATES[measurement]
+    return 'select TOP("score", "proc", %d) from (select SUM("value") as "score" from (select %s("%s") as "value" from %s where %s group by time(%s),"proc") group by "proc");' % (
+        top,
+        aggregate.upper(), field,
+        get_measurement(measurement, interval),
+        stat_filter(container, start_time, up_to, tags),
+        GROUP_INTERVALS[interval]
+    )
+
+
+def proc_totals_query(measurement, field, interval, container, start_time, up_to, tags=None):
+    '''
+    Return query of the sum of field of each proc of container
+    '''
+    return 'select SUM("%s") from %s where %s group by "proc";' % (
+        field,
+        get_measurement(measurement, interval),
+        stat_filter(container, start_time, up_to, tags)
+    )
@@ -0,0 +1,159 @@
+'''
+Live stats of containers
+
+bc_record publishes stats of each received message to a topic exchange,
+with container as routing key. Web workers bind their own queue to the
+containers being watched, so that each worker receives one stream per
+container whatever the number of viewers.
+'''
+import os
+import json
+import logging
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+EXCHANGE = 'bc_live'
+
+
+def routing_key(container):
+    # topic routing keys are dot separated words
+    return container.replace('.', '_')
+
+
+def encode(container, points):
+    '''
+    Encode influxdb points of a container as a live message
+    '''
+    stats = []
+    for point in points:
+        stats.append({
+            'measurement': point['measurement'],
+            'proc': point['tags']['proc'],
+            'system': point['tags'].get('system', None),
+            'ts': point['time'] / 1000000000.0,
+            'fields': point['fields']
+        })
+    return json.dumps({'container': container, 'stats': stats})
+
+
+class LiveHub(object):
+    '''
+    Dispatch live messages to subscribers of containers
+
+    A background thread owns the rabbitmq connection and an exclusive queue,
+    bound to containers having at least one subscriber. Each subscriber gets
+    a bounded queue of messages, messages are dropped if subscriber is too slow.
+    '''
+
+    def __init__(self, connect, max_size=100, listener=None):
+        # function returning a new pika.BlockingConnection
+        self.connect = connect
+        self.max_size = max_size
+        # optional function called with container of each received message
+        self.listener = listener
+        # container => list of subscriber queues
+        self.subscribers = {}
+        # bind/unbind requests for hub thread
+        self.commands = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        '''
+        Start hub thread if not already running in current process
+        '''
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                self.subscribers = {}
+                self.commands = queue.Queue()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='bc-live')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def subscribe(self, container):
+        '''
+        Return a queue receiving live messages of container
+        '''
+        self.start()
+        messages = queue.Queue(maxsize=self.max_size)
+        with self.lock:
+            if container not in self.subscribers:
+                self.subscribers[container] = []
+                self.commands.put(('bind', container))
+            self.subscribers[container].append(messages)
+        return messages
+
+    def unsubscribe(self, container, messages):
+        with self.lock:
+            subscribers = self.subscribers.get(container, [])
+            if messages in subscribers:
+                subscribers.remove(messages)
+            if not subscribers and container in self.subscribers:
+                del self.subscribers[container]
+                self.commands.put(('unbind', container))
+
+    def watched(self):
+        with self.lock:
+            return list(self.subscribers.keys())
+
+    def dispatch(self, ch, method, properties, body):
+        try:
+            container = json.loads(body)['container']
+        except Exception:
+            logging.warn('Live:Invalid message')
+            return
+        if self.listener is not None:
+            self.listener(container)
+        with self.lock:
+            subscribers = list(self.subscribers.get(container, []))
+        for messages in subscribers:
+            try:
+                messages.put_nowait(body)
+            except queue.Full:
+                pass
+
+    def run(self):
+        connection = None
+        channel = None
+        live_queue = None
+        delay = 1
+        while True:
+            try:
+                if connection is None or not connection.is_open:
+                    connection = self.connect()
+                    channel = connection.channel()
+                    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic')
+                    res = channel.queue_declare(exclusive=True, auto_delete=True)
+                    live_queue = res.method.queue
+                    # pending commands are covered by bindings below
+                    while not self.commands.empty():
+                        self.commands.get_nowait()
+                    for container in self.watched():
+                        channel.queue_bind(queue=live_queue, exchange=EXCHANGE, routing_key=routing_key(container))
+                    channel.basic_consume(self.dispatch, queue=live_queue, no_ack=True)
+                while not self.commands.empty():
+                    (command, container) = self.commands.get_nowait()
+                    if command == 'bind':
+                        channel.queue_bind(queue=live_queue, exchange=EXCHANGE, routing_key=routing_key(container))
+                    else:
+                        channel.queue_unbind(queue=live_queue, exchange=EXCHANGE, routing_key=routing_key(container))
+                connection.process_data_events(time_limit=0.5)
+                delay = 1
+            except Exception as e:
+                logging.exception('Live:Connection:Error:' + str(e))
+                try:
+                    if connection is not None and connection.is_open:
+                        connection.close()
+                except Exception:
+                    pass
+                connection = None
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
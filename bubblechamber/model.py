@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index
 import sqlalchemy as sa
 
 
@@ -35,6 +35,10 @@ class Container(Base):
 
 class Process(Base):
     __tablename__ = 'processes'
+    __table_args__ = (
+        # children of a process
+        Index('ix_processes_parent', 'container', 'parent_id'),
+    )
 
     container = Column(String(64), primary_key=True)
     process_id = Column(Integer, primary_key=True)
@@ -51,6 +55,11 @@ class Process(Base):
 
 class File(Base):
     __tablename__ = 'files'
+    __table_args__ = (
+        # files sorted by io, innodb appends primary key to secondary indexes
+        # so that keyset pagination on (io_total, process_id, name) reads index order
+        Index('ix_files_io_total', 'container', 'io_total'),
+    )
 
     container = Column(String(64), primary_key=True)
     process_id = Column(Integer, primary_key=True)
@@ -0,0 +1,116 @@
+import os
+import logging
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class EventPublisher(object):
+    '''
+    Publish messages to rabbitmq from a background thread
+
+    Messages are put in a bounded in-memory queue and taken by batches by a
+    thread owning the rabbitmq connection. Channel is transactional: all
+    messages of a batch are published, then committed together, so the
+    thread waits for the broker once per batch. Connection is opened again
+    on failure, and the whole uncommitted batch is sent again.
+    '''
+
+    def __init__(self, connect, routing_key='bc_record', max_size=10000, batch_size=100):
+        # function returning a new pika.BlockingConnection
+        self.connect = connect
+        self.routing_key = routing_key
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        '''
+        Start publisher thread if not already running in current process
+        '''
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                # messages queued in parent process belong to parent process
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='bc-publisher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def publish(self, body, properties):
+        '''
+        Queue a message, return False if queue is full
+        '''
+        self.start()
+        try:
+            self.queue.put_nowait((body, properties))
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def __next_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        connection = None
+        channel = None
+        batch = []
+        delay = 1
+        while True:
+            if not batch:
+                batch = self.__next_batch(1)
+                if not batch:
+                    if connection is not None:
+                        try:
+                            # keep connection alive while idle
+                            connection.process_data_events(0)
+                        except Exception as e:
+                            logging.warn('Publisher:Connection:Error:' + str(e))
+                            connection = None
+                    continue
+            try:
+                if connection is None or not connection.is_open:
+                    connection = self.connect()
+                    channel = connection.channel()
+                    channel.queue_declare(queue=self.routing_key, durable=True)
+                    channel.tx_select()
+                for (body, properties) in batch:
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=self.routing_key,
+                        body=body,
+                        properties=properties)
+                # messages are persisted once commit returns
+                channel.tx_commit()
+                batch = []
+                delay = 1
+            except Exception as e:
+                logging.exception('Failed to send record: ' + str(e))
+                try:
+                    if connection is not None and connection.is_open:
+                        connection.close()
+                except Exception:
+                    pass
+                connection = None
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
@@ -0,0 +1,241 @@
+'''
+Per minute and per hour rollups aggregated by bc_record
+'''
+import os
+import json
+import logging
+import time
+
+from bubblechamber import influx
+
+
+class Rollups(object):
+    '''
+    Aggregate stats per minute and per hour in memory
+
+    Buckets are closed on event time: the watermark of a container is the
+    most recent timestamp of its stats. A bucket is written to its rollup
+    retention policy once the watermark of its container is grace seconds
+    after its end, and written again if late stats are received while it is
+    kept in memory. It is forgotten one bucket size later, stats older than
+    forgotten buckets are not added to rollups so that a partial bucket never
+    overwrites a written one.
+
+    Once no stats of a container were received for idle_timeout seconds,
+    its watermark follows wall clock, so that last buckets of idle containers
+    are closed too.
+
+    Buckets are saved to a checkpoint file, so that they are not lost if
+    recorder is restarted. Between two checkpoint writes, added stats are
+    appended to a journal file, replayed on load.
+    '''
+
+    TIERS = influx.RECORDER_ROLLUPS
+
+    def __init__(self, checkpoint=None, grace=30, checkpoint_interval=60, idle_timeout=60):
+        self.checkpoint = checkpoint
+        # delay after end of bucket before writing it
+        self.grace = grace
+        # min delay between checkpoint writes
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_timeout = idle_timeout
+        self.last_save = 0
+        # buckets changed since last save
+        self.changed = False
+        # stats added since last save, appended to journal file on save
+        self.journal = []
+        # sequence of journal file of current checkpoint
+        self.sequence = 0
+        # most recent timestamp (s) of added stats, per container
+        self.watermarks = {}
+        # wall clock time of last added stats, per container
+        self.last_seen = {}
+        # stats dropped because their bucket was already forgotten
+        self.late = 0
+        # (retention policy, measurement, container, proc, system, start) => [fields, dirty]
+        self.buckets = {}
+        self.sizes = dict(self.TIERS)
+        self.aggregates = {}
+        for measurement in influx.ROLLUP_AGGREGATES:
+            for (aggregate, field) in influx.ROLLUP_AGGREGATES[measurement]:
+                self.aggregates[(measurement, field)] = aggregate
+        self.load()
+
+    def watermark(self, container, now=None):
+        '''
+        Return watermark (s) of container, moved forward by idle time once
+        container is idle
+        '''
+        if now is None:
+            now = time.time()
+        watermark = self.watermarks.get(container, 0)
+        idle = now - self.last_seen.get(container, now)
+        if idle >= self.idle_timeout:
+            watermark += int(idle)
+        return watermark
+
+    def add(self, measurement, container, proc, system, ts, fields, now=None):
+        '''
+        Add stats of timestamp ts (ns) to buckets
+        '''
+        if now is None:
+            now = time.time()
+        if self.checkpoint:
+            self.journal.append([measurement, container, proc, system, ts, fields])
+        ts = ts // 1000000000
+        watermark = max(self.watermark(container, now), ts)
+        self.watermarks[container] = watermark
+        self.last_seen[container] = now
+        for (retention_policy, size) in self.TIERS:
+            start = ts - ts % size
+            key = (retention_policy, measurement, container, proc, system, start)
+            bucket = self.buckets.get(key, None)
+            if bucket is None:
+                if watermark >= start + 2 * size + self.grace:
+                    # bucket may have been written and forgotten
+                    self.late += 1
+                    continue
+                self.buckets[key] = [dict(fields), True]
+                self.changed = True
+                continue
+            for field in fields:
+                if self.aggregates[(measurement, field)] == 'max':
+                    bucket[0][field] = max(bucket[0][field], fields[field])
+                else:
+                    bucket[0][field] += fields[field]
+            bucket[1] = True
+            self.changed = True
+
+    def pop_finished(self, now=None):
+        '''
+        Return points of modified finished buckets, per retention policy
+        '''
+        if now is None:
+            now = time.time()
+        watermarks = dict([(container, self.watermark(container, now)) for container in self.watermarks])
+        points = {}
+        for key in list(self.buckets.keys()):
+            (retention_policy, measurement, container, proc, system, start) = key
+            size = self.sizes[retention_policy]
+            bucket = self.buckets[key]
+            watermark = watermarks.get(container, 0)
+            if watermark < start + size + self.grace:
+                continue
+            if bucket[1]:
+                tags = {'container': container, 'proc': proc}
+                if system is not None:
+                    tags['system'] = system
+                if retention_policy not in points:
+                    points[retention_policy] = []
+                points[retention_policy].append({
+                    'measurement': measurement,
+                    'tags': tags,
+                    'time': start * 1000000000,
+                    'fields': dict(bucket[0])
+                })
+                bucket[1] = False
+                self.changed = True
+            if watermark >= start + 2 * size + self.grace:
+                del self.buckets[key]
+                self.changed = True
+        # forget containers without buckets, idle for longer than buckets are kept
+        max_age = max([2 * size + self.grace for (retention_policy, size) in self.TIERS])
+        active = set([key[2] for key in self.buckets])
+        for container in list(self.watermarks.keys()):
+            if container not in active and now - self.last_seen[container] >= max_age:
+                del self.watermarks[container]
+                del self.last_seen[container]
+                self.changed = True
+        if self.late:
+            logging.warn('Rollups:%d late stats of forgotten buckets not aggregated' % (self.late))
+            self.late = 0
+        return points
+
+    def save(self, force=False):
+        '''
+        Append stats added since last save to journal file, write all
+        buckets to checkpoint file instead every checkpoint_interval seconds
+        or if force is set
+        '''
+        if not self.checkpoint or not self.changed:
+            return
+        if force or time.time() - self.last_save >= self.checkpoint_interval:
+            self.__write_checkpoint()
+        else:
+            self.__write_journal()
+        self.changed = False
+
+    def __journal_file(self, sequence):
+        return '%s.journal.%d' % (self.checkpoint, sequence)
+
+    def __write_checkpoint(self):
+        # new journal file, so that a journal is never replayed on a
+        # checkpoint which already includes it
+        sequence = self.sequence + 1
+        tmp_file = self.checkpoint + '.tmp'
+        with open(tmp_file, 'w') as checkpoint:
+            json.dump({
+                'watermarks': self.watermarks,
+                'buckets': [list(key) + bucket for (key, bucket) in self.buckets.items()],
+                'journal': sequence
+            }, checkpoint)
+        os.rename(tmp_file, self.checkpoint)
+        if os.path.exists(self.__journal_file(self.sequence)):
+            os.remove(self.__journal_file(self.sequence))
+        self.sequence = sequence
+        self.journal = []
+        self.last_save = time.time()
+
+    def __write_journal(self):
+        if not self.journal:
+            return
+        try:
+            with open(self.__journal_file(self.sequence), 'a') as journal:
+                for elt in self.journal:
+                    journal.write(json.dumps(elt) + '\n')
+        except Exception as e:
+            # journal may be partially written, write checkpoint on next save
+            self.last_save = 0
+            raise e
+        self.journal = []
+
+    def load(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        try:
+            with open(self.checkpoint, 'r') as checkpoint:
+                content = json.load(checkpoint)
+            if isinstance(content, list):
+                # checkpoints of previous versions only have buckets
+                content = {'buckets': content}
+            for elt in content['buckets']:
+                key = tuple(elt[:6])
+                self.buckets[key] = [elt[6], elt[7]]
+                container = key[2]
+                self.watermarks[container] = max(self.watermarks.get(container, 0), key[5])
+            for container in content.get('watermarks', {}):
+                self.watermarks[container] = max(self.watermarks.get(container, 0), content['watermarks'][container])
+            # idle time of containers is counted from restart
+            now = time.time()
+            for container in self.watermarks:
+                self.last_seen[container] = now
+            logging.info('Loaded %d rollup buckets from %s' % (len(self.buckets), self.checkpoint))
+            self.sequence = content.get('journal', 0)
+        except Exception as e:
+            logging.exception('Failed to load rollups checkpoint: ' + str(e))
+            return
+        if not os.path.exists(self.__journal_file(self.sequence)):
+            return
+        count = 0
+        with open(self.__journal_file(self.sequence), 'r') as journal:
+            for line in journal:
+                try:
+                    elt = json.loads(line)
+                except ValueError:
+                    # last line of a killed recorder may be incomplete,
+                    # its messages were not acked
+                    break
+                self.add(*elt)
+                count += 1
+        self.journal = []
+        logging.info('Replayed %d rollup stats from journal' % (count))
@@ -0,0 +1,167 @@
+'''
+Stats queries of web servers, shared by bc_web_record and bc_web_async
+'''
+import base64
+import datetime
+import json
+import logging
+import math
+import numbers
+import time
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+import numpy
+
+# response formats of stats endpoints, selected with format query parameter
+FORMATS = ['json', 'columnar', 'msgpack']
+
+
+def window(last_updated, interval='s', since=None):
+    '''
+    Return (start_time, up_to) in ns of stats to query for interval,
+    up to last update of container
+
+    If since (s) is set, window starts at since
+    '''
+    start_time = last_updated - datetime.timedelta(seconds=3600)
+    if interval == 'm':
+        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24)
+    if interval == 'h':
+        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*2)
+    if interval == 'd':
+        start_time = datetime.datetime.now() - datetime.timedelta(seconds=3600*24*120)
+    logging.debug('Query stats after ' + str(start_time))
+    start_time = time.mktime(start_time.timetuple()) * 1000000000
+    up_to = time.mktime(last_updated.timetuple()) * 1000000000
+    if since is not None:
+        start_time = max(start_time, since * 1000000000)
+    return (start_time, up_to)
+
+
+def top_procs(res):
+    '''
+    Return procs of a top procs query result
+    '''
+    series = res.get('series', None)
+    if not series:
+        return []
+    proc_index = series[0]['columns'].index('proc')
+    return [value[proc_index] for value in series[0]['values']]
+
+
+# stats of these fields are sums or max of integer values
+INT_FIELDS = ('duration', 'vm_size', 'bytes')
+
+
+def decode_series(res, field_name, columnar=False):
+    '''
+    Decode series of a query with epoch timestamps, per proc
+
+    If columnar, return {proc: {'ts': [...], 'values': [...]}}
+    '''
+    result = {}
+    series = res.get('series', None)
+    if not series:
+        return result
+    for serie in series:
+        proc_id = serie['tags']['proc']
+        # None (empty group interval) values are decoded as nan
+        values = numpy.array(serie['values'], dtype=numpy.float64).reshape(-1, 2)
+        # timestamps are epoch seconds
+        timestamps = values[:, 0].astype(numpy.int64).tolist()
+        stats = numpy.nan_to_num(values[:, 1])
+        if field_name in INT_FIELDS:
+            stats = stats.astype(numpy.int64)
+        stats = stats.tolist()
+        if columnar:
+            result[proc_id] = {'ts': timestamps, 'values': stats}
+            continue
+        result[proc_id] = [
+            {'proc_name': proc_id, 'ts': timestamp, field_name: stat}
+            for (timestamp, stat) in zip(timestamps, stats)
+        ]
+    return result
+
+
+def proc_totals(res):
+    '''
+    Return value per proc id of a proc totals query result
+    '''
+    totals = {}
+    for serie in res.get('series', None) or []:
+        try:
+            totals[int(serie['tags']['proc'])] = serie['values'][0][1] or 0
+        except ValueError:
+            continue
+    return totals
+
+
+def cursor(result, since):
+    '''
+    Return start of last bucket of result, to be used as since of next query
+    so that last bucket is updated
+    '''
+    last = since
+    for proc_id in result:
+        if isinstance(result[proc_id], dict):
+            timestamps = result[proc_id]['ts']
+        else:
+            timestamps = [value['ts'] for value in result[proc_id]]
+        if timestamps and timestamps[-1] > last:
+            last = timestamps[-1]
+    return last
+
+
+def payload(result, since=None):
+    '''
+    Return response of stats query, wrapped with next cursor if since is set
+    '''
+    if since is None:
+        return result
+    return {'since': cursor(result, since), 'data': result}
+
+
+# sort columns of paginated files listing, files are returned by decreasing value
+FILE_SORTS = ['io_total', 'io_in', 'io_out']
+
+
+def file_entry(name, process_id, io_in, io_out, io_total, last_updated):
+    return {
+        'file_name': name,
+        'proc_id': process_id,
+        'io_in': io_in,
+        'io_out': io_out,
+        'io_total': io_total,
+        'last_updated': last_updated
+    }
+
+
+def encode_cursor(key):
+    '''
+    Return cursor of next page of a paginated listing, from (sort value, process id, file name)
+    of last returned file
+    '''
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    Return (sort value, process id, file name) of a cursor, None if cursor is invalid
+    '''
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except Exception:
+        return None
+    if not isinstance(key, list) or len(key) != 3:
+        return None
+    (value, process_id, name) = key
+    if isinstance(value, bool) or not isinstance(value, numbers.Real) or math.isnan(value) or math.isinf(value):
+        return None
+    if isinstance(process_id, bool) or not isinstance(process_id, numbers.Integral):
+        return None
+    if not isinstance(name, string_types):
+        return None
+    return (value, process_id, name)
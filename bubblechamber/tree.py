@@ -0,0 +1,140 @@
+'''
+Process tree of a container, built from (process, parent) pairs
+'''
+from collections import deque
+
+
+def get_children(parents):
+    '''
+    Return sorted children of each process
+    '''
+    children = {}
+    for (proc_id, parent_id) in parents.items():
+        if parent_id == proc_id:
+            continue
+        if parent_id not in children:
+            children[parent_id] = []
+        children[parent_id].append(proc_id)
+    for parent_id in children:
+        children[parent_id].sort()
+    return children
+
+
+def get_roots(parents):
+    '''
+    Return sorted processes whose parent is not a process of the container
+    '''
+    return sorted([proc_id for (proc_id, parent_id) in parents.items() if parent_id not in parents or parent_id == proc_id])
+
+
+def inclusive_totals(parents, children, values):
+    '''
+    Return sum of values of each process and its descendants
+
+    Pids can be reused in long running containers, a process seen twice
+    while walking the tree (cycle) is counted once
+    '''
+    totals = {}
+    visited = set()
+    for root in list(parents.keys()):
+        if root in visited:
+            continue
+        # iterative post-order walk
+        stack = [(root, False)]
+        while stack:
+            (proc_id, expanded) = stack.pop()
+            if expanded:
+                total = values.get(proc_id, 0)
+                for child in children.get(proc_id, []):
+                    total += totals.get(child, 0)
+                totals[proc_id] = total
+                continue
+            if proc_id in visited:
+                continue
+            visited.add(proc_id)
+            stack.append((proc_id, True))
+            for child in children.get(proc_id, []):
+                if child not in visited:
+                    stack.append((child, False))
+    return totals
+
+
+def walk(children, top, depth, limit):
+    '''
+    Return nodes of top processes, with up to limit children per node, down to depth
+
+    Each node is {'id': proc_id, 'nb_children': ..., 'children': [...]}
+    '''
+    nodes = []
+    # (node, remaining depth)
+    pending = deque()
+    seen = set()
+    for proc_id in top:
+        node = {'id': proc_id, 'nb_children': len(children.get(proc_id, [])), 'children': []}
+        nodes.append(node)
+        pending.append((node, depth))
+        seen.add(proc_id)
+    while pending:
+        (node, remaining) = pending.popleft()
+        if remaining <= 1:
+            continue
+        for child in children.get(node['id'], [])[:limit]:
+            if child in seen:
+                continue
+            seen.add(child)
+            child_node = {'id': child, 'nb_children': len(children.get(child, [])), 'children': []}
+            node['children'].append(child_node)
+            pending.append((child_node, remaining - 1))
+    return nodes
+
+
+def iter_nodes(nodes):
+    '''
+    Iterate over nodes and their descendants
+    '''
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(node['children'])
+
+
+def select(parents, root=None, offset=0, limit=100, depth=3):
+    '''
+    Return (children, number of top processes, nodes of a page of top processes)
+
+    Top processes are children of root, or root processes if root is None.
+    nodes is None if root is not a process of the container.
+    '''
+    children = get_children(parents)
+    if root is None:
+        top = get_roots(parents)
+    elif root in parents:
+        top = children.get(root, [])
+    else:
+        return (children, 0, None)
+    return (children, len(top), walk(children, top[offset:offset + limit], depth, limit))
+
+
+def descendants(children, top):
+    '''
+    Return set of top processes and of their descendants
+    '''
+    result = set(top)
+    pending = list(top)
+    while pending:
+        for child in children.get(pending.pop(), []):
+            if child not in result:
+                result.add(child)
+                pending.append(child)
+    return result
+
+
+def annotate(nodes, details, cpu_totals, io_totals):
+    '''
+    Add details (dict of process fields per process) and cpu and io totals to nodes
+    '''
+    for node in iter_nodes(nodes):
+        node.update(details.get(node['id'], {}))
+        node['cpu'] = cpu_totals.get(node['id'], 0)
+        node['io'] = io_totals.get(node['id'], 0)
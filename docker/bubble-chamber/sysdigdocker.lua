@@ -20,6 +20,8 @@ short_description = "Top processes by CPU usage"
 category = "CPU Usage"
 
 remote_server = nil
+compression = nil
+zlib = nil
 -- Chisel argument list
 args = {
     {
@@ -28,12 +30,26 @@ args = {
         argtype = "string",
         optional = false
     },
+    {
+        name = "compress",
+        description = "compress events sent to server, supported: gzip (needs lua-zlib)",
+        argtype = "string",
+        optional = true
+    },
 }
 
 -- Argument notification callback
 function on_set_arg(name, val)
     if name == "url" then
         remote_server = val
+    elseif name == "compress" then
+        if val == "gzip" then
+            compression = val
+            zlib = require("zlib")
+        else
+            print("unsupported compression " .. val)
+            return false
+        end
     end
     return true
 end
@@ -81,14 +97,18 @@ function send_data(stable, ts_s, ts_ns, timedelta, viz_info, evt_type)
 		local res = {ts = sysdig.make_ts(ts_s, ts_ns), data = jdata, evt_type=evt_type, jinfo=jinfo}
 			
 		local str = json.encode(res)
+		local headers = {["Content-Type"] = "application/json"}
+		if compression == "gzip" then
+		    -- window size 31 produces a gzip stream
+		    str = zlib.deflate(6, 31)(str, "finish")
+		    headers["Content-Encoding"] = "gzip"
+		end
+		headers["Content-Length"] = string.len(str)
 		http.request{
                     -- url = "http://131.254.17.40:8000/event",
                     url = remote_server,
 		    method = "POST",
-		    headers = {
-                      ["Content-Type"] = "application/json",
-		      ["Content-Length"] = string.len(str)
-		    },
+		    headers = headers,
                     source = ltn12.source.string(str),
 		    sink = ltn12.sink.table(out)
 		}
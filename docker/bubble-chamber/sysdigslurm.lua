@@ -20,6 +20,8 @@ short_description = "Top processes by CPU usage with slurm cgroups"
 category = "CPU Usage"
 
 remote_server = nil
+compression = nil
+zlib = nil
 -- Chisel argument list
 args = {
     {
@@ -28,12 +30,26 @@ args = {
         argtype = "string",
         optional = false
     },
+    {
+        name = "compress",
+        description = "compress events sent to server, supported: gzip (needs lua-zlib)",
+        argtype = "string",
+        optional = true
+    },
 }
 
 -- Argument notification callback
 function on_set_arg(name, val)
     if name == "url" then
         remote_server = val
+    elseif name == "compress" then
+        if val == "gzip" then
+            compression = val
+            zlib = require("zlib")
+        else
+            print("unsupported compression " .. val)
+            return false
+        end
     end
     return true
 end
@@ -81,14 +97,18 @@ function send_data(stable, ts_s, ts_ns, timedelta, viz_info, evt_type)
 		local res = {ts = sysdig.make_ts(ts_s, ts_ns), data = jdata, evt_type=evt_type, jinfo=jinfo}
 
 		local str = json.encode(res)
+		local headers = {["Content-Type"] = "application/json"}
+		if compression == "gzip" then
+		    -- window size 31 produces a gzip stream
+		    str = zlib.deflate(6, 31)(str, "finish")
+		    headers["Content-Encoding"] = "gzip"
+		end
+		headers["Content-Length"] = string.len(str)
 		http.request{
                     -- url = "http://131.254.17.40:8000/event",
                     url = remote_server,
 		    method = "POST",
-		    headers = {
-                      ["Content-Type"] = "application/json",
-		      ["Content-Length"] = string.len(str)
-		    },
+		    headers = headers,
                     source = ltn12.source.string(str),
 		    sink = ltn12.sink.table(out)
 		}
@@ -108,6 +128,40 @@ vizinfo =
 
 vizinfofd = {}
 
+-- position of cgroup field in keys
+cgroup_key_idx = nil
+cgroup_fdkey_idx = nil
+-- container of cgroup cpusets, memoised per cpuset string
+cgroup_cache = {}
+cgroup_cache_size = 0
+
+-- Return container of a cgroup cpuset (job_XX for slurm jobs),
+-- false if events of this cgroup should not be sent (docker containers)
+function get_container(cpuset)
+	local container = cgroup_cache[cpuset]
+	if container ~= nil then
+		return container
+	end
+	container = cpuset
+	if string.sub(cpuset, 1, 1) == "/" then
+		if string.find(cpuset, "/docker", 1, true) then
+			container = false
+		elseif string.find(cpuset, "/slurm", 1, true) then
+			local job = string.match(cpuset, "/(job_[^/]*)")
+			if job ~= nil then
+				container = job
+			end
+		end
+	end
+	if cgroup_cache_size >= 10000 then
+		cgroup_cache = {}
+		cgroup_cache_size = 0
+	end
+	cgroup_cache[cpuset] = container
+	cgroup_cache_size = cgroup_cache_size + 1
+	return container
+end
+
 -- Initialization callback
 function on_init()
 	-- The -pc or -pcontainer options was supplied on the cmd line
@@ -130,9 +184,15 @@ function on_init()
 	-- Request the fields we need
 	for i, name in ipairs(vizinfo.key_fld) do
 		fkeys[i] = chisel.request_field(name)
+		if name == "thread.cgroup.cpuset" then
+			cgroup_key_idx = i
+		end
 	end
         for i, name in ipairs(vizinfofd.key_fld) do
                 fdkeys[i] = chisel.request_field(name)
+                if name == "thread.cgroup.cpuset" then
+                        cgroup_fdkey_idx = i
+                end
         end
 
 	-- Request the fields we need
@@ -185,6 +245,15 @@ function on_event()
 	 	 return true
         end
 
+	-- filter and normalise cgroups here, so that ignored events are not sent
+	local container = nil
+	if containerName ~= nil then
+		container = get_container(containerName)
+		if container == false then
+			return true
+		end
+	end
+
     local nokey = false
 	for i, fld in ipairs(fkeys) do
 		kv = evt.field(fld)
@@ -192,11 +261,14 @@ function on_event()
 			nokey = true
 			break
 		end
+		if i == cgroup_key_idx then
+			kv = container
+		end
 
 		if key == nil then
 			key = kv
 		else
-			key = key .. "\001\001" .. evt.field(fld)
+			key = key .. "\001\001" .. kv
 		end
 	end
 
@@ -223,11 +295,14 @@ function on_event()
 			nokey = true
                         break
                 end
+                if i == cgroup_fdkey_idx then
+                        kv = container
+                end
 
                 if key == nil then
                         key = kv
                 else
-                        key = key .. "\001\001" .. evt.field(fld)
+                        key = key .. "\001\001" .. kv
                 end
         end
 	if nokey then
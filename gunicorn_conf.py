@@ -1,3 +1,8 @@
+def when_ready(server):
+    # register to consul once, from master process
+    import bc_web_record
+    bc_web_record.consul_declare(bc_web_record.config)
+
 def worker_exit(server, worker):
     from prometheus_client import multiprocess
     multiprocess.mark_process_dead(worker.pid)
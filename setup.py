@@ -72,12 +72,24 @@ setup(
                       'python-consul',
                       'pika==0.12.0',
                       'influxdb',
+                      'numpy',
+                      'futures; python_version < "3"',
                       'SQLAlchemy',
                       'MySQL-Python'
                      ],
+    extras_require={
+        # zstd compressed events
+        'zstd': ['zstandard'],
+        # msgpack format of stats endpoints
+        'msgpack': ['msgpack'],
+        # bc_web_async read api, python 3 only
+        'async': ['aiohttp', 'aiomysql'],
+    },
+    test_suite='tests',
     scripts=[
             'bc_api.py',
             'bc_web_record.py',
+            'bc_web_async.py',
             'bc_db.py',
             'bc_record.py'
     ],
@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+from bubblechamber.cache import LRUCache, ApiKeyCache, QueryCache
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self):
+        self.value += 1
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_hit(self):
+        hits = Counter()
+        misses = Counter()
+        cache = QueryCache(hits=hits, misses=misses)
+        self.assertEqual(cache.get('k', 60, lambda: None), None)
+        # None results are cached too
+        self.assertEqual(cache.get('k', 60, lambda: 1), None)
+        self.assertEqual((hits.value, misses.value), (1, 1))
+
+    def test_single_flight(self):
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'result'
+
+        cache = QueryCache()
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get('k', 60, compute)))
+        first.start()
+        started.wait()
+        others = [threading.Thread(target=lambda: results.append(cache.get('k', 60, compute))) for i in range(3)]
+        for thread in others:
+            thread.start()
+        for thread in [first] + others:
+            thread.join()
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(len(calls), 1)
+
+
+class TestApiKeyCache(unittest.TestCase):
+
+    def test_is_valid(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return ['key1']
+
+        keys = ApiKeyCache(load, refresh=3600, min_reload=3600)
+        self.assertTrue(keys.is_valid('key1'))
+        self.assertEqual(len(loads), 1)
+        # unknown key does not reload again before min_reload
+        self.assertFalse(keys.is_valid('key2'))
+        self.assertFalse(keys.is_valid('key2'))
+        self.assertEqual(len(loads), 1)
+        keys.add('key2')
+        self.assertTrue(keys.is_valid('key2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
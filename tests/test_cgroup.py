@@ -0,0 +1,19 @@
+import unittest
+
+from bubblechamber import cgroup
+
+
+class TestCgroup(unittest.TestCase):
+
+    def test_classify(self):
+        self.assertEqual(cgroup.classify('262b281ffa9d'), ('262b281ffa9d', False))
+        self.assertEqual(cgroup.classify('/docker/262b281ffa9d'), (None, False))
+        self.assertEqual(cgroup.classify('/slurm/uid_1000/job_42/step_0'), ('job_42', True))
+        self.assertEqual(cgroup.classify('job_42'), ('job_42', True))
+        self.assertEqual(cgroup.classify('/user.slice'), ('/user.slice', False))
+        # memoised result
+        self.assertEqual(cgroup.classify('/slurm/uid_1000/job_42/step_0'), ('job_42', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
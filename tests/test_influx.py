@@ -0,0 +1,24 @@
+import unittest
+
+from bubblechamber import influx
+
+
+class TestInflux(unittest.TestCase):
+
+    def test_duration_seconds(self):
+        self.assertEqual(influx.duration_seconds('2d'), 172800)
+        self.assertEqual(influx.duration_seconds('168h0m0s'), 604800)
+        self.assertIsNone(influx.duration_seconds('0s'))
+        self.assertIsNone(influx.duration_seconds('INF'))
+
+    def test_rollup_queries(self):
+        queries = dict((name, select) for (name, rp, select, group_interval) in influx.rollup_queries('bc'))
+        self.assertIn('FROM "bc"."bc_1m"."cpu"', queries['bc_1h_cpu'])
+        queries = dict((name, select) for (name, rp, select, group_interval) in influx.rollup_queries('bc', from_raw=True))
+        for name in queries:
+            self.assertIn('FROM "bc".."', queries[name])
+        self.assertIn('INTO "bc"."bc_1d"."io"', queries['bc_1d_io'])
+
+
+if __name__ == '__main__':
+    unittest.main()
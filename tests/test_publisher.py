@@ -0,0 +1,106 @@
+import os
+import time
+import unittest
+
+from bubblechamber.publisher import EventPublisher
+
+
+class FakeChannel(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.pending = []
+
+    def queue_declare(self, queue, durable=False):
+        pass
+
+    def tx_select(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.pending.append(body)
+
+    def tx_commit(self):
+        if self.broker.failures:
+            self.broker.failures -= 1
+            raise Exception('connection lost')
+        self.broker.commits.append(self.pending)
+        self.pending = []
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self.broker)
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeBroker(object):
+    '''
+    Committed batches of messages, commits fail failures times
+    '''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.commits = []
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        return FakeConnection(self)
+
+    def messages(self):
+        return [body for batch in self.commits for body in batch]
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
+
+class TestEventPublisher(unittest.TestCase):
+
+    def test_batches(self):
+        broker = FakeBroker()
+        publisher = EventPublisher(broker.connect, max_size=10, batch_size=4)
+        # queue messages before publisher thread starts
+        publisher.pid = os.getpid()
+        for i in range(6):
+            publisher.queue.put_nowait((str(i), None))
+        publisher.start()
+        wait_for(lambda: len(broker.messages()) == 6)
+        self.assertEqual(broker.messages(), [str(i) for i in range(6)])
+        self.assertEqual([len(batch) for batch in broker.commits], [4, 2])
+        self.assertEqual(broker.connections, 1)
+
+    def test_failed_commit(self):
+        broker = FakeBroker(failures=1)
+        publisher = EventPublisher(broker.connect)
+        self.assertTrue(publisher.publish('a', None))
+        wait_for(lambda: broker.messages())
+        # uncommitted batch is sent again on a new connection
+        self.assertEqual(broker.messages(), ['a'])
+        self.assertEqual(broker.connections, 2)
+
+    def test_full_queue(self):
+        broker = FakeBroker()
+        publisher = EventPublisher(broker.connect, max_size=1)
+        # no publisher thread to take messages
+        publisher.start = lambda: None
+        self.assertTrue(publisher.publish('a', None))
+        self.assertFalse(publisher.publish('b', None))
+        self.assertEqual(publisher.depth(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import json
+import unittest
+import zlib
+
+import pika
+
+import bc_record
+
+
+class Method(object):
+
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeChannel(object):
+    '''
+    Record publishes and acks of a rabbitmq channel
+    '''
+
+    def __init__(self):
+        self.published = []
+        self.acks = []
+        self.nacks = []
+        self.commits = 0
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.published.append((routing_key, body, properties))
+        return True
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacks.append((delivery_tag, requeue))
+
+    def tx_commit(self):
+        self.commits += 1
+
+
+def gzip_properties():
+    return pika.BasicProperties(content_encoding='gzip', headers={'api': 'key'})
+
+
+def config():
+    return {
+        'mysql': {'url': 'sqlite://'},
+        'influxdb': {'host': None},
+        'rabbitmq': {'live': False, 'max_event_size': 1000}
+    }
+
+
+class TestDecodeEvent(unittest.TestCase):
+
+    def test_decode(self):
+        event = {'evt_type': 'cpu', 'ts': 1, 'data': []}
+        self.assertEqual(bc_record.decode_event(None, json.dumps(event)), event)
+        self.assertEqual(bc_record.decode_event(None, json.dumps({'event': event})), event)
+        body = bc_record.gzip_compress(json.dumps(event).encode('utf-8'))
+        self.assertEqual(bc_record.decode_event(gzip_properties(), body), event)
+
+    def test_max_size(self):
+        body = json.dumps({'evt_type': 'cpu', 'data': [' ' * 1000]}).encode('utf-8')
+        with self.assertRaises(bc_record.EventTooLarge):
+            bc_record.decode_event(None, body, max_size=1000)
+        # 10MB of zeros
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        bomb = compressor.compress(b'0' * 10 * 1024 * 1024) + compressor.flush()
+        with self.assertRaises(bc_record.EventTooLarge):
+            bc_record.decode_event(gzip_properties(), bomb, max_size=1000)
+
+    @unittest.skipIf(bc_record.zstandard is not None, 'zstandard is installed')
+    def test_unsupported_encoding(self):
+        with self.assertRaises(bc_record.UnsupportedEncoding):
+            bc_record.decode_event(pika.BasicProperties(content_encoding='zstd'), b'\x28\xb5\x2f\xfd')
+
+
+class TestFailedMessages(unittest.TestCase):
+
+    def test_record(self):
+        handler = bc_record.RetentionHandler(config())
+        handler.channel = FakeChannel()
+        handler.callback_record(handler.channel, Method(1), gzip_properties(), b'not gzip')
+        self.assertEqual(len(handler.channel.published), 1)
+        (routing_key, body, properties) = handler.channel.published[0]
+        self.assertEqual(routing_key, bc_record.FAILED_QUEUE)
+        self.assertEqual(body, b'not gzip')
+        self.assertEqual(properties.content_encoding, 'gzip')
+        self.assertEqual(properties.headers['api'], 'key')
+        self.assertIn('error', properties.headers)
+        # acked with next flush, never requeued
+        self.assertTrue(handler.flush())
+        self.assertEqual(handler.channel.acks, [(1, True)])
+        self.assertEqual(handler.channel.nacks, [])
+
+    def test_route(self):
+        router = bc_record.ShardRouter(2, [0, 0], max_event_size=1000)
+        channel = FakeChannel()
+        body = json.dumps({'evt_type': 'cpu', 'data': [' ' * 1000]}).encode('utf-8')
+        router.callback_route(channel, Method(1), pika.BasicProperties(), body)
+        self.assertEqual([routing_key for (routing_key, body, properties) in channel.published], [bc_record.FAILED_QUEUE])
+        self.assertEqual(channel.acks, [(1, False)])
+
+
+def cpu_row(container):
+    return [0, 'bash', 12, 0, 1000, container, '/bin/bash', '', 1, 10]
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.routed = [0, 0]
+        self.router = bc_record.ShardRouter(2, self.routed, batch_size=2)
+        self.channel = FakeChannel()
+        self.router.channel = self.channel
+        # containers of each shard
+        self.containers = {}
+        for i in range(20):
+            self.containers.setdefault(self.router.get_shard('c%d' % (i)), []).append('c%d' % (i))
+
+    def test_split(self):
+        (c0, c1) = (self.containers[0][0], self.containers[1][0])
+        docker = '/docker/' + 'a' * 64
+        content = {'evt_type': 'cpu', 'data': [cpu_row(c0), cpu_row(c1), cpu_row(c0), cpu_row(docker)]}
+        shards = self.router.split(content)
+        self.assertEqual(sorted(shards.keys()), [0, 1])
+        self.assertEqual([row[5] for row in shards[0]], [c0, c0])
+        self.assertEqual([row[5] for row in shards[1]], [c1])
+        self.assertEqual(self.router.split({'evt_type': 'other', 'data': []}), {})
+
+    def test_single_shard_forwarded(self):
+        content = {'evt_type': 'cpu', 'ts': 1, 'data': [cpu_row(name) for name in self.containers[1][:2]]}
+        body = bc_record.gzip_compress(json.dumps(content).encode('utf-8'))
+        self.router.callback_route(self.channel, Method(1), gzip_properties(), body)
+        self.assertEqual(len(self.channel.published), 1)
+        (routing_key, sub_body, properties) = self.channel.published[0]
+        self.assertEqual(routing_key, 'bc_record_1')
+        self.assertEqual(sub_body, body)
+        self.assertEqual(properties.content_encoding, 'gzip')
+        self.assertEqual(properties.headers, {'api': 'key'})
+        self.assertEqual(self.routed, [0, 2])
+
+    def test_split_message(self):
+        content = {'evt_type': 'cpu', 'ts': 1, 'data': [cpu_row(self.containers[0][0]), cpu_row(self.containers[1][0])]}
+        body = bc_record.gzip_compress(json.dumps(content).encode('utf-8'))
+        self.router.callback_route(self.channel, Method(1), gzip_properties(), body)
+        published = dict([(routing_key, (sub_body, properties)) for (routing_key, sub_body, properties) in self.channel.published])
+        self.assertEqual(sorted(published.keys()), ['bc_record_0', 'bc_record_1'])
+        for shard in (0, 1):
+            (sub_body, properties) = published['bc_record_%d' % (shard)]
+            sub_content = bc_record.decode_event(properties, sub_body)
+            self.assertEqual(sub_content['ts'], 1)
+            self.assertEqual([row[5] for row in sub_content['data']], [self.containers[shard][0]])
+        self.assertEqual(self.routed, [1, 1])
+
+    def test_batch_commit(self):
+        body = json.dumps({'evt_type': 'cpu', 'ts': 1, 'data': [cpu_row(self.containers[0][0])]})
+        self.router.callback_route(self.channel, Method(1), pika.BasicProperties(), body)
+        # acked in transaction, not committed yet
+        self.assertEqual(self.channel.acks, [(1, False)])
+        self.assertEqual(self.channel.commits, 0)
+        self.router.callback_route(self.channel, Method(2), pika.BasicProperties(), body)
+        self.assertEqual(self.channel.commits, 1)
+        self.router.callback_route(self.channel, Method(3), pika.BasicProperties(), body)
+        self.router.commit()
+        self.assertEqual(self.channel.commits, 2)
+        # nothing to commit
+        self.router.commit()
+        self.assertEqual(self.channel.commits, 2)
+
+    def test_message_without_rows(self):
+        body = json.dumps({'evt_type': 'cpu', 'ts': 1, 'data': [cpu_row('/docker/' + 'a' * 64)]})
+        self.router.callback_route(self.channel, Method(1), pika.BasicProperties(), body)
+        self.assertEqual(self.channel.published, [])
+        self.assertEqual(self.channel.acks, [(1, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
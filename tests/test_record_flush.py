@@ -0,0 +1,138 @@
+import json
+import unittest
+
+import bc_record
+
+from tests.test_record import FakeChannel, Method, config, cpu_row
+
+
+class FakeInflux(object):
+    '''
+    influxdb client failing the first failures writes
+    '''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.writes = []
+
+    def write_points(self, points, retention_policy=None, batch_size=None):
+        if self.failures:
+            self.failures -= 1
+            raise Exception('influxdb is down')
+        self.writes.append((retention_policy, points))
+
+
+class FakeConnection(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        if self.engine.fail:
+            raise Exception('mysql is down')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, stmt):
+        self.engine.statements.append(stmt)
+
+
+class FakeEngine(object):
+
+    def __init__(self):
+        self.fail = False
+        self.statements = []
+
+    def begin(self):
+        return FakeConnection(self)
+
+
+class TestInfluxBuffer(unittest.TestCase):
+
+    def test_flush(self):
+        db_influx = FakeInflux()
+        buf = bc_record.InfluxBuffer(db_influx, max_points=3)
+        buf.add([{'measurement': 'cpu'}, {'measurement': 'mem'}])
+        self.assertFalse(buf.is_full())
+        buf.add([{'measurement': 'cpu'}], 'bc_1m')
+        self.assertTrue(buf.is_full())
+        self.assertTrue(buf.flush())
+        self.assertEqual(sorted([(rp or '', len(points)) for (rp, points) in db_influx.writes]), [('', 2), ('bc_1m', 1)])
+        self.assertEqual(buf.depth(), 0)
+
+    def test_retry(self):
+        db_influx = FakeInflux(failures=1)
+        buf = bc_record.InfluxBuffer(db_influx, retries=1)
+        buf.add([{'measurement': 'cpu'}])
+        self.assertTrue(buf.flush())
+        self.assertEqual(len(db_influx.writes), 1)
+
+    def test_failure_keeps_points(self):
+        db_influx = FakeInflux(failures=1)
+        buf = bc_record.InfluxBuffer(db_influx, retries=0)
+        buf.add([{'measurement': 'cpu'}])
+        self.assertFalse(buf.flush())
+        self.assertEqual(buf.depth(), 1)
+        self.assertTrue(buf.flush())
+        self.assertEqual(buf.depth(), 0)
+
+
+class TestRetentionHandlerFlush(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = bc_record.RetentionHandler(config())
+        self.handler.channel = FakeChannel()
+        self.handler.engine = FakeEngine()
+        self.db_influx = FakeInflux()
+        self.handler.influx_buffer = bc_record.InfluxBuffer(self.db_influx, retries=0)
+
+    def record(self, delivery_tag):
+        body = json.dumps({'evt_type': 'cpu', 'ts': 1000000000, 'data': [cpu_row('c1')]})
+        self.handler.callback_record(self.handler.channel, Method(delivery_tag), None, body)
+
+    def test_ack(self):
+        self.record(1)
+        self.record(2)
+        self.assertEqual(self.handler.channel.acks, [])
+        self.assertTrue(self.handler.flush())
+        # a single ack covers previous deliveries
+        self.assertEqual(self.handler.channel.acks, [(2, True)])
+        self.assertEqual(len(self.handler.engine.statements), 2)
+        self.assertEqual(len(self.db_influx.writes[0][1]), 4)
+        self.assertEqual(self.handler.deliveries, [])
+
+    def test_influx_failure(self):
+        self.record(1)
+        self.db_influx.failures = 1
+        self.assertFalse(self.handler.flush())
+        self.assertEqual(self.handler.channel.acks, [])
+        self.record(2)
+        self.assertTrue(self.handler.flush())
+        self.assertEqual(self.handler.channel.acks, [(2, True)])
+        self.assertEqual(sum([len(points) for (rp, points) in self.db_influx.writes]), 4)
+
+    def test_sql_failure(self):
+        self.record(1)
+        self.handler.engine.fail = True
+        self.assertFalse(self.handler.flush())
+        self.assertEqual(self.handler.channel.acks, [])
+        # pending changes are kept for next flush
+        self.assertEqual(list(self.handler.sql_procs.keys()), [('c1', 12)])
+        self.handler.engine.fail = False
+        self.assertTrue(self.handler.flush())
+        self.assertEqual(self.handler.channel.acks, [(1, True)])
+        self.assertEqual(self.handler.sql_procs, {})
+
+    def test_prefetch_window(self):
+        self.handler.prefetch = 2
+        self.record(1)
+        self.assertEqual(self.handler.channel.acks, [])
+        # flushed once prefetch window is full
+        self.record(2)
+        self.assertEqual(self.handler.channel.acks, [(2, True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bubblechamber.rollups import Rollups
+
+# start of an hour, in seconds
+BASE = 1000000 * 3600
+
+
+def ns(seconds):
+    return (BASE + seconds) * 1000000000
+
+
+class TestRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp_dir, 'rollups.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_aggregates(self):
+        rollups = Rollups(grace=0)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 2})
+        rollups.add('cpu', 'c1', '1', None, ns(10), {'duration': 3})
+        rollups.add('mem', 'c1', '1', None, ns(1), {'vm_size': 5})
+        rollups.add('mem', 'c1', '1', None, ns(10), {'vm_size': 4})
+        rollups.add('io', 'c1', '1', 1, ns(1), {'in': 1, 'out': 2, 'total': 3})
+        rollups.add('cpu', 'c1', '1', None, ns(60), {'duration': 1})
+        points = rollups.pop_finished()
+        self.assertEqual(list(points.keys()), ['bc_1m'])
+        fields = dict([(point['measurement'], point['fields']) for point in points['bc_1m']])
+        self.assertEqual(fields['cpu'], {'duration': 5})
+        self.assertEqual(fields['mem'], {'vm_size': 5})
+        self.assertEqual(fields['io'], {'in': 1, 'out': 2, 'total': 3})
+        for point in points['bc_1m']:
+            self.assertEqual(point['time'], ns(0))
+            if point['measurement'] == 'io':
+                self.assertEqual(point['tags'], {'container': 'c1', 'proc': '1', 'system': 1})
+            else:
+                self.assertEqual(point['tags'], {'container': 'c1', 'proc': '1'})
+
+    def test_closed_on_event_time(self):
+        rollups = Rollups(grace=30)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1})
+        # wall clock is far after bucket end, no stats after it were received
+        self.assertEqual(rollups.pop_finished(), {})
+        rollups.add('cpu', 'c1', '1', None, ns(89), {'duration': 1})
+        self.assertEqual(rollups.pop_finished(), {})
+        rollups.add('cpu', 'c1', '1', None, ns(90), {'duration': 1})
+        self.assertEqual(len(rollups.pop_finished()['bc_1m']), 1)
+
+    def test_late_stats_rewrite_bucket(self):
+        rollups = Rollups(grace=0)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1})
+        rollups.add('cpu', 'c1', '1', None, ns(60), {'duration': 1})
+        self.assertEqual(rollups.pop_finished()['bc_1m'][0]['fields'], {'duration': 1})
+        # unchanged bucket is not written again
+        self.assertEqual(rollups.pop_finished(), {})
+        rollups.add('cpu', 'c1', '1', None, ns(2), {'duration': 2})
+        points = rollups.pop_finished()['bc_1m']
+        self.assertEqual([point['fields'] for point in points if point['time'] == ns(0)], [{'duration': 3}])
+
+    def test_backlog_does_not_overwrite_buckets(self):
+        rollups = Rollups(grace=30)
+        rollups.add('cpu', 'c1', '1', None, ns(5), {'duration': 1})
+        rollups.add('cpu', 'c1', '1', None, ns(200), {'duration': 1})
+        points = rollups.pop_finished()['bc_1m']
+        self.assertEqual([point['fields'] for point in points], [{'duration': 1}])
+        # minute bucket is forgotten, late stats must not start a partial bucket
+        rollups.add('cpu', 'c1', '1', None, ns(10), {'duration': 1})
+        self.assertNotIn(('bc_1m', 'cpu', 'c1', '1', None, BASE), rollups.buckets)
+        self.assertNotIn('bc_1m', rollups.pop_finished())
+        # hour bucket is still open and gets all stats
+        bucket = rollups.buckets[('bc_1h', 'cpu', 'c1', '1', None, BASE)]
+        self.assertEqual(bucket[0], {'duration': 3})
+
+    def test_watermark_per_container(self):
+        rollups = Rollups(grace=30)
+        # clock of c1 host is ahead
+        rollups.add('cpu', 'c1', '1', None, ns(300), {'duration': 1})
+        for i in range(120):
+            rollups.add('cpu', 'c2', '1', None, ns(i), {'duration': 1})
+        self.assertEqual(rollups.late, 0)
+        points = rollups.pop_finished()['bc_1m']
+        self.assertEqual([(point['tags']['container'], point['fields']) for point in points], [('c2', {'duration': 60})])
+
+    def test_idle_container(self):
+        rollups = Rollups(grace=30, idle_timeout=60)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1}, now=1000)
+        self.assertEqual(rollups.pop_finished(now=1059), {})
+        # no stats for 100s, watermark is 101
+        points = rollups.pop_finished(now=1100)
+        self.assertEqual([point['fields'] for point in points['bc_1m']], [{'duration': 1}])
+        self.assertEqual(rollups.pop_finished(now=1200), {})
+        # late stats of forgotten bucket
+        rollups.add('cpu', 'c1', '1', None, ns(2), {'duration': 1}, now=1200)
+        self.assertEqual(rollups.late, 1)
+        # idle container without buckets is forgotten
+        rollups.pop_finished(now=1200 + 2 * 3600 + 30)
+        self.assertEqual(rollups.buckets, {})
+        self.assertEqual(rollups.watermarks, {})
+
+    def test_checkpoint(self):
+        rollups = Rollups(checkpoint=self.checkpoint, grace=0)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1})
+        rollups.save()
+        loaded = Rollups(checkpoint=self.checkpoint, grace=0)
+        self.assertEqual(loaded.buckets, rollups.buckets)
+        self.assertEqual(loaded.watermarks, {'c1': BASE + 1})
+
+    def test_checkpoint_interval(self):
+        rollups = Rollups(checkpoint=self.checkpoint, checkpoint_interval=3600)
+        rollups.save()
+        # nothing to save
+        self.assertFalse(os.path.exists(self.checkpoint))
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1})
+        rollups.save()
+        self.assertTrue(os.path.exists(self.checkpoint))
+        rollups.add('cpu', 'c1', '1', None, ns(2), {'duration': 1})
+        rollups.save()
+        with open(self.checkpoint, 'r') as checkpoint:
+            self.assertIn('"duration": 1', checkpoint.read())
+        # journal is replayed on load
+        self.assertEqual(Rollups(checkpoint=self.checkpoint).buckets[('bc_1m', 'cpu', 'c1', '1', None, BASE)][0], {'duration': 2})
+        rollups.add('cpu', 'c1', '1', None, ns(3), {'duration': 1})
+        rollups.save(force=True)
+        self.assertEqual(os.listdir(self.tmp_dir), ['rollups.json'])
+        self.assertEqual(Rollups(checkpoint=self.checkpoint).buckets[('bc_1m', 'cpu', 'c1', '1', None, BASE)][0], {'duration': 3})
+
+    def test_journal_replay(self):
+        rollups = Rollups(checkpoint=self.checkpoint, checkpoint_interval=3600)
+        rollups.add('cpu', 'c1', '1', None, ns(1), {'duration': 1})
+        rollups.save()
+        rollups.add('cpu', 'c1', '1', None, ns(2), {'duration': 2})
+        rollups.add('io', 'c1', '1', 0, ns(2), {'in': 1, 'out': 0, 'total': 1})
+        rollups.save()
+        # killed while appending to journal
+        with open(self.checkpoint + '.journal.1', 'a') as journal:
+            journal.write('["cpu", "c1", "1", nu')
+        loaded = Rollups(checkpoint=self.checkpoint, checkpoint_interval=3600)
+        self.assertEqual(loaded.buckets, rollups.buckets)
+        self.assertEqual(loaded.watermarks, rollups.watermarks)
+        # replayed stats are in next checkpoint
+        loaded.save()
+        self.assertFalse(os.path.exists(self.checkpoint + '.journal.1'))
+        self.assertEqual(Rollups(checkpoint=self.checkpoint).buckets, rollups.buckets)
+
+if __name__ == '__main__':
+    unittest.main()
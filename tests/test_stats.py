@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import unittest
+
+from bubblechamber import stats
+
+
+def encode(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+class TestStats(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        for key in [(10, 1, '/etc/hosts'), (1.5, 2, u'/tmp/é'), (0, 0, '')]:
+            self.assertEqual(stats.decode_cursor(stats.encode_cursor(key)), key)
+
+    def test_invalid_cursor(self):
+        self.assertIsNone(stats.decode_cursor('not a cursor'))
+        self.assertIsNone(stats.decode_cursor(encode([1, 2])))
+        self.assertIsNone(stats.decode_cursor(encode({'a': 1})))
+        self.assertIsNone(stats.decode_cursor(encode([{}, 1, 'a'])))
+        self.assertIsNone(stats.decode_cursor(encode([True, 1, 'a'])))
+        self.assertIsNone(stats.decode_cursor(encode([1, 1.5, 'a'])))
+        self.assertIsNone(stats.decode_cursor(encode([1, [1], 'a'])))
+        self.assertIsNone(stats.decode_cursor(encode([1, 1, None])))
+
+    def test_decode_series(self):
+        res = {'series': [{'tags': {'proc': '12'}, 'columns': ['time', 'sum'], 'values': [[10, 1], [20, None]]}]}
+        self.assertEqual(stats.decode_series(res, 'duration', columnar=True), {'12': {'ts': [10, 20], 'values': [1, 0]}})
+        self.assertEqual(stats.decode_series(res, 'duration'), {'12': [
+            {'proc_name': '12', 'ts': 10, 'duration': 1},
+            {'proc_name': '12', 'ts': 20, 'duration': 0}
+        ]})
+        series = stats.decode_series(res, 'duration', columnar=True)['12']
+        self.assertTrue(all(isinstance(value, int) for value in series['ts'] + series['values']))
+        self.assertEqual(json.dumps(stats.decode_series(res, 'duration')['12'][0]['duration']), '1')
+        self.assertEqual(stats.decode_series(res, 'other', columnar=True)['12']['values'], [1.0, 0.0])
+        self.assertEqual(stats.decode_series({}, 'duration'), {})
+
+    def test_since_cursor(self):
+        result = {'1': {'ts': [10, 20], 'values': [1, 2]}, '2': [{'ts': 30}]}
+        self.assertEqual(stats.cursor(result, 0), 30)
+        self.assertEqual(stats.payload(result, 0)['since'], 30)
+        self.assertEqual(stats.payload(result), result)
+
+    def test_top_procs(self):
+        res = {'series': [{'columns': ['time', 'top', 'proc'], 'values': [[0, 5, '12'], [0, 3, '13']]}]}
+        self.assertEqual(stats.top_procs(res), ['12', '13'])
+        self.assertEqual(stats.top_procs({}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
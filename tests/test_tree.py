@@ -0,0 +1,67 @@
+import unittest
+
+from bubblechamber import tree
+
+# 1 -> 2, 3 ; 2 -> 4 ; 10 -> 11 ; 20 has an unknown parent
+PARENTS = {1: 0, 2: 1, 3: 1, 4: 2, 10: 0, 11: 10, 20: 99}
+
+
+class TestTree(unittest.TestCase):
+
+    def test_children_and_roots(self):
+        children = tree.get_children(PARENTS)
+        self.assertEqual(children[1], [2, 3])
+        self.assertEqual(children[0], [1, 10])
+        self.assertEqual(tree.get_roots(PARENTS), [1, 10, 20])
+
+    def test_inclusive_totals(self):
+        children = tree.get_children(PARENTS)
+        values = {1: 1, 2: 2, 3: 3, 4: 4, 10: 10, 11: 11}
+        totals = tree.inclusive_totals(PARENTS, children, values)
+        self.assertEqual(totals[4], 4)
+        self.assertEqual(totals[2], 6)
+        self.assertEqual(totals[1], 10)
+        self.assertEqual(totals[10], 21)
+        self.assertEqual(totals[20], 0)
+
+    def test_inclusive_totals_cycle(self):
+        # reused pids may build a cycle
+        parents = {1: 2, 2: 1, 3: 2}
+        children = tree.get_children(parents)
+        totals = tree.inclusive_totals(parents, children, {1: 1, 2: 2, 3: 3})
+        self.assertEqual(max(totals.values()), 6)
+
+    def test_walk(self):
+        children = tree.get_children(PARENTS)
+        nodes = tree.walk(children, [1], 2, 10)
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual(nodes[0]['nb_children'], 2)
+        self.assertEqual([child['id'] for child in nodes[0]['children']], [2, 3])
+        # depth 2 stops before grand children
+        self.assertEqual(nodes[0]['children'][0]['children'], [])
+        self.assertEqual(nodes[0]['children'][0]['nb_children'], 1)
+
+    def test_walk_limit(self):
+        children = tree.get_children(PARENTS)
+        nodes = tree.walk(children, [1], 3, 1)
+        self.assertEqual([child['id'] for child in nodes[0]['children']], [2])
+        self.assertEqual(nodes[0]['nb_children'], 2)
+        self.assertEqual(sorted([node['id'] for node in tree.iter_nodes(nodes)]), [1, 2, 4])
+
+    def test_select(self):
+        (children, total, nodes) = tree.select(PARENTS, None, offset=1, limit=1, depth=2)
+        self.assertEqual(total, 3)
+        self.assertEqual([node['id'] for node in nodes], [10])
+        (children, total, nodes) = tree.select(PARENTS, 1, depth=1)
+        self.assertEqual(total, 2)
+        self.assertEqual([node['id'] for node in nodes], [2, 3])
+        self.assertIsNone(tree.select(PARENTS, 42)[2])
+
+    def test_descendants(self):
+        children = tree.get_children(PARENTS)
+        self.assertEqual(tree.descendants(children, [1]), set([1, 2, 3, 4]))
+        self.assertEqual(tree.descendants(children, [3, 10]), set([3, 10, 11]))
+
+
+if __name__ == '__main__':
+    unittest.main()